@@ -0,0 +1,186 @@
+"""Generates synthetic page texts and specimen records for benchmarks
+
+Catalog numbers are assigned to departments in blocks, and the record for a
+given number is derived from the number itself, so the stub portal and the
+generated pages agree about which specimen a number refers to without any
+shared state.
+"""
+import hashlib
+import random
+
+
+
+
+DEPARTMENTS = [
+    "Invertebrate Zoology",
+    "Paleobiology",
+    "Mineral Sciences",
+    "Vertebrate Zoology: Fishes",
+    "Vertebrate Zoology: Birds",
+    "Botany",
+]
+
+GENERA = [
+    "Acropora", "Ammonites", "Balanus", "Calcite", "Conus", "Dendraster",
+    "Exogyra", "Fusinus", "Gadus", "Halichoerus", "Inoceramus", "Lepomis",
+    "Murex", "Nautilus", "Olivella", "Pecten", "Quartz", "Rhynchonella",
+    "Spirifer", "Turritella", "Uca", "Venus", "Zircon",
+]
+
+COUNTRIES = [
+    "United States", "Mexico", "Canada", "Brazil", "Peru", "Japan",
+    "Philippines", "Australia", "Madagascar", "Norway",
+]
+
+FORMATIONS = [
+    "Green River Formation", "Morrison Formation", "Calvert Formation",
+    "Burgess Shale", "Hell Creek Formation",
+]
+
+WORDS = (
+    "the of and in a to is was for on with as by from at that this are were"
+    " be specimen specimens collected described figured plate figure shell"
+    " valve length width height mm anterior posterior margin surface species"
+    " genus type holotype paratype locality station depth fathoms near"
+    " collection museum material examined remarks description diagnosis"
+    " similar differs larger smaller ribs spines aperture suture outer inner"
+).split()
+
+# Forms used to mention catalog numbers in running text
+FORMS = [
+    "USNM {num}",
+    "USNM {num}",
+    "USNM {num}",
+    "NMNH {num}",
+    "USNM {num}{suffix}",
+    "(USNM {num})",
+    "U.S.N.M. No. {num}",
+    "USNM {num}-{end}",
+    "USNM Nos. {num}, {next}, and {end}",
+]
+
+
+
+
+def department(num):
+    """Returns the department for a catalog number"""
+    return DEPARTMENTS[(num // 25000) % len(DEPARTMENTS)]
+
+
+def specimen_record(num, index=0):
+    """Builds a portal record for a catalog number
+
+    Args:
+        num (int): the catalog number
+        index (int): distinguishes multiple records with the same number
+
+    Returns:
+        dict resembling a Darwin Core record from the portal
+    """
+    rng = random.Random(num * 31 + index)
+    dept = department(num)
+    genus = rng.choice(GENERA)
+    ark = hashlib.md5(f"{num}-{index}".encode("utf-8")).hexdigest()
+    rec = {
+        "occurrenceID": f"http://n2t.net/ark:/65665/3{ark}",
+        "institutionCode": "NMNH",
+        "collectionCode": dept,
+        "catalogNumber": f"USNM {num}",
+        "scientificName": f"{genus} {rng.choice(WORDS)}us",
+        "higherClassification": f"Animalia | {genus[:4]}idae | {genus}",
+        "genus": genus,
+        "family": f"{genus[:4]}idae",
+        "country": rng.choice(COUNTRIES),
+        "stateProvince": "",
+        "county": "",
+        "verbatimLocality": f"Station {rng.randint(1, 5000)}",
+        "higherGeography": "",
+        "typeStatus": rng.choice(["", "", "", "Holotype", "Paratype"]),
+        "associatedReferences": "",
+    }
+    if dept == "Paleobiology":
+        rec["formation"] = rng.choice(FORMATIONS)
+    return rec
+
+
+def context(num):
+    """Returns text that matches the record for a catalog number"""
+    rec = specimen_record(num)
+    return f"{rec['scientificName']} from {rec['country']}"
+
+
+def catalog_number(rng):
+    """Picks a catalog number, favoring a few dense blocks"""
+    block = int(rng.paretovariate(1.2)) % 40
+    return block * 25000 + rng.randint(1, 24999)
+
+
+def mention(rng):
+    """Returns (text, numbers) for one mention of one or more numbers"""
+    num = catalog_number(rng)
+    form = rng.choice(FORMS)
+    step = rng.randint(1, 3)
+    text = form.format(
+        num=num,
+        suffix=rng.choice("abc"),
+        next=num + step,
+        end=num + 2 * step,
+    )
+    return text, [num]
+
+
+def page_text(rng, density=2.0, context_rate=0.7, num_words=400,
+              blank_rate=0.9):
+    """Generates the text of one page
+
+    Args:
+        rng (random.Random): the random number generator
+        density (float): mean number of mentions on a page that has any
+        context_rate (float): fraction of mentions followed by text that
+            matches the specimen record
+        num_words (int): approximate length of the page in words
+        blank_rate (float): fraction of pages with no museum code at all
+
+    Returns:
+        Tuple of (text, numbers mentioned)
+    """
+    words = [rng.choice(WORDS) for _ in range(num_words)]
+    numbers = []
+
+    # Most pages never mention the museum
+    if rng.random() < blank_rate:
+        return " ".join(words), numbers
+
+    # Pages that do usually mention a few specimens, some are dense tables
+    if rng.random() < 0.875:
+        count = max(1, int(rng.expovariate(1 / density)))
+    else:
+        count = rng.randint(30, 100)
+
+    for _ in range(count):
+        text, nums = mention(rng)
+        if rng.random() < context_rate:
+            text = f"{text}, {context(nums[0])}"
+        words.insert(rng.randrange(len(words)), text)
+        numbers.extend(nums)
+
+    # Bare museum codes are picked up as candidates by the miner
+    for _ in range(rng.randint(0, 2)):
+        words.insert(rng.randrange(len(words)), "USNM")
+
+    return " ".join(words), numbers
+
+
+def generate_pages(num_pages, seed=0, **kwargs):
+    """Generates a list of page texts
+
+    Args:
+        num_pages (int): number of pages
+        seed (int): seed for the random number generator
+        kwargs: keyword arguments passed to page_text
+
+    Returns:
+        list of page texts
+    """
+    rng = random.Random(seed)
+    return [page_text(rng, **kwargs)[0] for _ in range(num_pages)]
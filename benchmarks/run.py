@@ -0,0 +1,273 @@
+"""Runs offline benchmarks for the miners, SessionWrapper, and matchers
+
+Each benchmark builds its own temporary citations database, generates a
+synthetic corpus, and replaces the portal with a stub, so nothing touches
+the network. Benchmarks run in a fresh process by default so that the peak
+RSS reported for each one is its own. Usage:
+
+    python benchmarks/run.py
+    python benchmarks/run.py --pages 5000 --only find_snippets commit
+    python benchmarks/run.py --json results.json
+"""
+import argparse
+import concurrent.futures
+import contextlib
+import csv
+import io
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import time
+
+from corpus import generate_pages, mention
+from stubs import install_portal, temp_citations_db
+
+
+
+
+BENCHMARKS = {}
+
+
+
+
+def benchmark(name, **params):
+    """Registers a benchmark function under a name"""
+    def decorator(func):
+        BENCHMARKS[name] = (func, params)
+        return func
+    return decorator
+
+
+def populate(num_pages, seed=0, pages_per_doc=20, blank_rate=0.9):
+    """Mines a synthetic corpus into the current citations database
+
+    Returns:
+        the Miner used to populate the database
+    """
+    from speciminer.databases.citations import Document
+    from speciminer.miners import Miner
+
+    miner = Miner()
+    pages = []
+    for i, text in enumerate(generate_pages(num_pages, seed=seed, blank_rate=blank_rate)):
+        doc_url = f"https://example.org/doc/{i // pages_per_doc}"
+        if not i % pages_per_doc:
+            miner.session.add(Document(
+                url=doc_url,
+                kind="article",
+                authors="Smith, J.",
+                title=f"Synthetic document {i // pages_per_doc}",
+                year=str(1900 + i % 120),
+            ))
+        pages.append((text, doc_url, f"{doc_url}#{i % pages_per_doc}"))
+    miner.find_snippets_many(pages)
+    miner.session.flush()
+    return miner
+
+
+def count_rows(table):
+    """Counts the rows in a table in the current citations database"""
+    from speciminer.databases.citations import Session
+
+    session = Session()
+    try:
+        return session.execute(f"SELECT count(*) FROM {table}").scalar()
+    finally:
+        session.close()
+
+
+@benchmark("find_snippets")
+def bench_find_snippets(args):
+    """Times Miner.find_snippets on generated pages"""
+    from speciminer.miners import Miner
+
+    pages = generate_pages(args.pages, seed=args.seed,
+                           blank_rate=args.blank_rate)
+    with temp_citations_db():
+        miner = Miner()
+        start = time.perf_counter()
+        for i, text in enumerate(pages):
+            miner.find_snippets(text, f"https://example.org/doc/{i // 20}", str(i))
+        miner.session.flush()
+        return len(pages), "pages", time.perf_counter() - start
+
+
+def bench_commit(args, dup_rate):
+    """Times SessionWrapper commits for records with a given duplicate rate"""
+    from speciminer.databases.citations import Session, Snippet
+    from speciminer.utils import SessionWrapper
+
+    rng = random.Random(args.seed)
+    records = []
+    for i in range(args.records):
+        # Duplicates repeat an earlier id with identical values
+        j = rng.randrange(i) if i and rng.random() < dup_rate else i
+        records.append(Snippet(
+            id=f"{j:032x}",
+            doc_url=f"https://example.org/doc/{j // 50}",
+            page_id=str(j % 50),
+            snippet=f"Specimen USNM {j} was figured on plate {j % 12}",
+        ))
+
+    with temp_citations_db():
+        session = SessionWrapper(
+            Session, limit=10000, bulk=True, on_conflict="update", cache_size=100000
+        )
+        start = time.perf_counter()
+        for i in range(0, len(records), 1000):
+            session.add_all(records[i:i + 1000])
+        session.flush()
+        elapsed = time.perf_counter() - start
+        session.close()
+        return len(records), "records", elapsed
+
+
+for dup_rate in (0.0, 0.5, 0.9):
+    benchmark(f"commit[dup={dup_rate}]", dup_rate=dup_rate)(bench_commit)
+
+
+def bench_parse_catnums(args, cached):
+    """Times building CatNums from verbatim strings with or without the cache"""
+    from nmnh_ms_tools.records import CatNums
+    from speciminer.utils import PARSE_CACHE, parse_catnums
+
+    # Numbers repeat across documents, so draw them from a limited pool
+    rng = random.Random(args.seed)
+    pool = [mention(rng)[0] for _ in range(max(1, args.records // 10))]
+    vals = [rng.choice(pool) for _ in range(args.records)]
+
+    PARSE_CACHE.clear()
+    parse = parse_catnums if cached else CatNums
+    start = time.perf_counter()
+    for val in vals:
+        parse([val])
+    return len(vals), "values", time.perf_counter() - start
+
+
+for cached in (False, True):
+    benchmark(f"parse_catnums[cached={cached}]", cached=cached)(bench_parse_catnums)
+
+
+@benchmark("match")
+def bench_match(args):
+    """Times DatabaseMatcher.match against the stub portal"""
+    from speciminer.matchers import DatabaseMatcher
+
+    install_portal()
+    with temp_citations_db():
+        populate(args.pages, seed=args.seed, blank_rate=args.blank_rate)
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            DatabaseMatcher().match()
+        return count_rows("links"), "links", time.perf_counter() - start
+
+
+@benchmark("match_from_ranges")
+def bench_match_from_ranges(args):
+    """Times DatabaseMatcher.match_from_ranges after an initial match"""
+    from speciminer.matchers import DatabaseMatcher
+
+    install_portal()
+    with temp_citations_db():
+        populate(args.pages, seed=args.seed, blank_rate=args.blank_rate)
+        with contextlib.redirect_stdout(io.StringIO()):
+            DatabaseMatcher().match()
+            start = time.perf_counter()
+            DatabaseMatcher().match_from_ranges()
+        return count_rows("links"), "links", time.perf_counter() - start
+
+
+@benchmark("to_csv")
+def bench_to_csv(args):
+    """Times DatabaseMatcher.to_csv after an initial match"""
+    from speciminer.matchers import DatabaseMatcher
+
+    install_portal()
+    with temp_citations_db() as path:
+        populate(args.pages, seed=args.seed, blank_rate=args.blank_rate)
+        output = os.path.join(os.path.dirname(path), "export.csv")
+        with contextlib.redirect_stdout(io.StringIO()):
+            DatabaseMatcher().match()
+            start = time.perf_counter()
+            DatabaseMatcher().to_csv(output)
+        elapsed = time.perf_counter() - start
+        with open(output, encoding="utf-8-sig", newline="") as f:
+            num_rows = sum(1 for _ in csv.reader(f)) - 1
+        return num_rows, "rows", elapsed
+
+
+def peak_rss():
+    """Returns the peak resident set size of this process in MB"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return rss / 2 ** 20 if sys.platform == "darwin" else rss / 2 ** 10
+
+
+def run_benchmark(name, args):
+    """Runs one benchmark and returns its results as a dict"""
+    func, params = BENCHMARKS[name]
+    ops, unit, seconds = func(args, **params)
+    return {
+        "name": name,
+        "ops": ops,
+        "unit": unit,
+        "seconds": seconds,
+        "ops_per_sec": ops / seconds if seconds else 0,
+        "peak_rss_mb": peak_rss(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pages", type=int, default=2000,
+                        help="number of generated pages to mine")
+    parser.add_argument("--records", type=int, default=50000,
+                        help="number of records to commit")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed for the corpus generator")
+    parser.add_argument("--blank-rate", type=float, default=0.9,
+                        help="fraction of pages with no museum code")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="number of times to run each benchmark")
+    parser.add_argument("--only", nargs="+", default=[],
+                        help="run benchmarks whose names start with these")
+    parser.add_argument("--inline", action="store_true",
+                        help="run in this process instead of a fresh one")
+    parser.add_argument("--json", help="path to write results to as JSON")
+    args = parser.parse_args(argv)
+
+    names = [n for n in BENCHMARKS
+             if not args.only or n.startswith(tuple(args.only))]
+    if not names:
+        parser.error(f"No benchmarks match {args.only}")
+
+    results = []
+    print(f"{'benchmark':<22} {'ops':>9} {'unit':<8} {'seconds':>9}"
+          f" {'ops/sec':>11} {'peak RSS':>10}")
+    for name in names:
+        for _ in range(args.repeat):
+            if args.inline:
+                result = run_benchmark(name, args)
+            else:
+                context = multiprocessing.get_context("spawn")
+                with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=1, mp_context=context
+                ) as executor:
+                    result = executor.submit(run_benchmark, name, args).result()
+            results.append(result)
+            print(f"{result['name']:<22} {result['ops']:>9,} {result['unit']:<8}"
+                  f" {result['seconds']:>9.2f} {result['ops_per_sec']:>11,.1f}"
+                  f" {result['peak_rss_mb']:>8.1f}MB")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,516 @@
+"""Fills citations databases with synthetic rows and times the matchers
+
+The generator writes documents, snippets, specimens, links, and Darwin Core
+records with distributions that resemble a production database. Catalog
+numbers follow a Zipfian distribution so that a few are cited by many
+documents, most xDD documents have a single snippet, and a few BHL items
+have thousands. Links and Darwin Core records are derived from the stub
+portal, so the matchers see the same records the generator used.
+
+The driver generates a database at each size, then runs each DatabaseMatcher
+pass and the CSV export against it in a fresh process, in the order they run
+in production. It reports time, peak memory, and how each pass scales with
+row count, and plots the results if matplotlib is installed. Usage:
+
+    python benchmarks/scale.py
+    python benchmarks/scale.py --sizes 100k 1M --passes match to_csv
+    python benchmarks/scale.py --dir /data/scale --plot scale.png --json scale.json
+
+Generated databases are kept in --dir and reused by later runs unless
+--regenerate is given.
+"""
+import argparse
+import concurrent.futures
+import contextlib
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import time
+from functools import lru_cache
+
+from corpus import WORDS, context
+from run import peak_rss
+from stubs import StubPortal, install_portal
+
+try:
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+except ImportError:
+    plt = None
+
+
+
+
+TABLES = ["documents", "snippets", "specimens", "links", "dwc"]
+
+# Passes in the order they run in production. The follow-up passes retry
+# the misses recorded by match.
+PASSES = ["match", "match_from_snippets", "match_from_ranges", "to_csv"]
+
+# Relative frequency of each kind of document. BHL items are rare, but each
+# one has thousands of snippets.
+KINDS = {
+    "xdd": 0.6,
+    "bhl_part": 0.2,
+    "jstor": 0.1998,
+    "bhl_item": 0.0002,
+}
+
+URLS = {
+    "xdd": "https://doi.org/10.5555/xdd.{}",
+    "bhl_part": "https://biodiversitylibrary.org/part/{}",
+    "jstor": "https://www.jstor.org/stable/{}",
+    "bhl_item": "https://biodiversitylibrary.org/item/{}",
+}
+
+PUBLICATIONS = [
+    "Proceedings of the United States National Museum",
+    "Smithsonian Contributions to Paleobiology",
+    "Journal of Paleontology",
+    "American Mineralogist",
+    "The Nautilus",
+    "Copeia",
+    "The Auk",
+]
+
+# Catalog numbers are drawn from a fixed range long enough for the matcher
+MIN_CATNUM = 10000
+NUM_CATNUMS = 990000
+
+# Scales the snippet count for a BHL item
+ITEM_SNIPPETS = 2000
+
+SIZE_SUFFIXES = {"k": 10 ** 3, "m": 10 ** 6, "g": 10 ** 9}
+
+
+
+
+def parse_size(val):
+    """Parses a row count like 500k or 10M"""
+    val = val.strip().lower()
+    try:
+        if val[-1] in SIZE_SUFFIXES:
+            return int(float(val[:-1]) * SIZE_SUFFIXES[val[-1]])
+        return int(val)
+    except (IndexError, ValueError):
+        raise ValueError(f"Invalid size: {val!r}")
+
+
+def format_size(num):
+    """Formats a row count like 500k or 10M"""
+    for suffix, mult in sorted(SIZE_SUFFIXES.items(), key=lambda kv: -kv[1]):
+        if num >= mult and not num % mult:
+            return f"{num // mult}{suffix.upper() if suffix != 'k' else suffix}"
+    return str(num)
+
+
+def zipf_number(rng):
+    """Picks a catalog number so that the nth most common number is picked
+    about 1/n as often as the most common one"""
+    # Inverse transform sampling for a Zipf distribution with an exponent of 1
+    rank = int(NUM_CATNUMS ** rng.random())
+    # Scatter ranks so the most popular numbers span departments
+    return MIN_CATNUM + rank * 7919 % NUM_CATNUMS
+
+
+def snippet_count(rng, kind):
+    """Picks the number of snippets in a document of a given kind"""
+    if kind == "xdd":
+        return 1
+    if kind == "bhl_item":
+        return min(int(ITEM_SNIPPETS * rng.paretovariate(1.5)), 25 * ITEM_SNIPPETS)
+    if kind == "bhl_part":
+        return min(int(3 * rng.paretovariate(1.2)), 500)
+    return rng.randint(1, 20)
+
+
+def document(rng, kind, index):
+    """Builds the row for one document"""
+    url = URLS[kind].format(index)
+    year = str(rng.randint(1850, 2023))
+    publication = rng.choice(PUBLICATIONS)
+    title = f"{' '.join(rng.choices(WORDS, k=6)).capitalize()} ({index})"
+    return {
+        "url": url,
+        "kind": "book" if kind == "bhl_item" else "article",
+        "authors": f"Author{index % 997}, A.",
+        "title": publication if kind == "bhl_item" else title,
+        "year": year,
+        "publication": publication,
+        "volume": str(rng.randint(1, 150)),
+        "number": str(rng.randint(1, 12)),
+        "pages": f"{rng.randint(1, 400)}-{rng.randint(401, 800)}",
+        "doi": url[16:] if kind == "xdd" else None,
+        "topic": None,
+    }
+
+
+def generate_rows(num_rows, seed=0, hit_rate=0.9, link_rate=0.8):
+    """Generates rows for a citations database
+
+    Documents are generated whole, so the total may exceed num_rows by the
+    rows for one document.
+
+    Args:
+        num_rows (int): approximate number of rows across all tables
+        seed (int): seed for the random number generator
+        hit_rate (float): fraction of catalog numbers the stub portal finds
+        link_rate (float): fraction of found numbers saved as links. The
+            rest are saved as misses for the follow-up passes to retry.
+
+    Yields:
+        tuple of (table, row as a dict)
+    """
+    rng = random.Random(seed)
+    portal = StubPortal(hit_rate=hit_rate)
+    get_records = lru_cache(maxsize=2 ** 16)(portal.get_specimen_by_id)
+    get_context = lru_cache(maxsize=2 ** 16)(context)
+    kinds = list(KINDS)
+    weights = list(KINDS.values())
+    dwc_ids = set()
+    page_num = 0
+    count = 0
+    index = 0
+
+    while count < num_rows:
+        index += 1
+        kind = rng.choices(kinds, weights)[0]
+        doc = document(rng, kind, index)
+        doc_url = doc["url"]
+        yield "documents", doc
+        count += 1
+
+        # Monographs and catalogs cite runs of nearby numbers, which is what
+        # match_from_ranges uses to fill in misses
+        base = MIN_CATNUM + rng.randrange(NUM_CATNUMS - 5000)
+        more = 0.6 if kind == "bhl_item" else 0.35
+
+        spec_nums = {}
+        for _ in range(snippet_count(rng, kind)):
+            if kind.startswith("bhl"):
+                page_num += rng.random() < 0.5
+                page_id = f"https://www.biodiversitylibrary.org/page/{page_num}"
+            else:
+                page_id = ""
+
+            nums = []
+            while not nums or (rng.random() < more and len(nums) < 20):
+                if rng.random() < 0.6:
+                    nums.append(zipf_number(rng))
+                else:
+                    nums.append(base + rng.randint(0, 5000))
+
+            mentions = []
+            for num in nums:
+                mention = f"USNM {num}"
+                if rng.random() < 0.7:
+                    mention = f"{mention}, {get_context(num)}"
+                mentions.append(mention)
+            text = " ".join([
+                " ".join(rng.choices(WORDS, k=rng.randint(5, 30))),
+                "; ".join(mentions),
+                " ".join(rng.choices(WORDS, k=rng.randint(5, 30))),
+            ])
+
+            snippet_id = _md5(doc_url + page_id + text)
+            yield "snippets", {
+                "id": snippet_id,
+                "doc_url": doc_url,
+                "page_id": page_id,
+                "snippet": text,
+            }
+            count += 1
+
+            for num in nums:
+                spec_num = f"USNM {num}"
+                yield "specimens", {
+                    "id": _md5(snippet_id + spec_num),
+                    "snippet_id": snippet_id,
+                    "verbatim": spec_num,
+                    "spec_num": spec_num,
+                }
+                count += 1
+                spec_nums[spec_num] = num
+
+        # Links use the same ids as DatabaseMatcher so the passes update them
+        for spec_num in spec_nums:
+            records = get_records(spec_num)
+            link = {
+                "id": _md5(doc_url + spec_num),
+                "doc_url": doc_url,
+                "verbatim": "na",
+                "spec_num": spec_num,
+                "ezid": None,
+                "department": None,
+                "match_quality": "MISS",
+            }
+            if records and rng.random() < link_rate:
+                link["ezid"] = " | ".join(sorted(r["occurrenceID"] for r in records))
+                link["department"] = records[0]["collectionCode"]
+                link["match_quality"] = "Matched catalog number and snippet"
+            yield "links", link
+            count += 1
+
+            if link["ezid"]:
+                for rec in records:
+                    if rec["occurrenceID"] not in dwc_ids:
+                        dwc_ids.add(rec["occurrenceID"])
+                        yield "dwc", {
+                            "id": rec["occurrenceID"],
+                            "higher_classification": rec["higherClassification"],
+                            "scientific_name": rec["scientificName"],
+                            "type_status": rec["typeStatus"],
+                            "higher_geography": rec["higherGeography"],
+                            "verbatim_locality": rec["verbatimLocality"],
+                        }
+                        count += 1
+
+
+def generate_db(path, num_rows, seed=0, chunk_size=50000, **kwargs):
+    """Creates a citations database filled with generated rows
+
+    Args:
+        path (str): path to the database
+        num_rows (int): approximate number of rows across all tables
+        seed (int): seed for the random number generator
+        chunk_size (int): number of rows to insert at once
+        kwargs: keyword arguments passed to generate_rows
+
+    Returns:
+        dict of row counts keyed by table
+    """
+    from sqlalchemy.orm import close_all_sessions
+    from speciminer.databases.citations import Base, Session, bulk_load, init_db
+
+    init_db(path)
+    tables = {t: Base.metadata.tables[t] for t in TABLES}
+    batches = {t: [] for t in TABLES}
+
+    with bulk_load() as bind:
+
+        def flush(table):
+            # Ignore the rare snippet that repeats on the same page
+            stmt = tables[table].insert().prefix_with("OR IGNORE")
+            with bind.begin() as conn:
+                conn.execute(stmt, batches[table])
+            batches[table] = []
+
+        for table, row in generate_rows(num_rows, seed=seed, **kwargs):
+            batches[table].append(row)
+            if len(batches[table]) >= chunk_size:
+                flush(table)
+        for table in TABLES:
+            if batches[table]:
+                flush(table)
+
+    close_all_sessions()
+    Session.kw["bind"].dispose()
+    return count_rows(path)
+
+
+def count_rows(path):
+    """Counts the rows in each generated table of a database"""
+    with contextlib.closing(sqlite3.connect(path)) as conn:
+        return {t: conn.execute(f"SELECT count(*) FROM {t}").fetchone()[0]
+                for t in TABLES}
+
+
+def run_generate(path, num_rows, seed=0):
+    """Generates a database and returns counts, time, and peak memory"""
+    start = time.perf_counter()
+    counts = generate_db(path, num_rows, seed=seed)
+    return {
+        "pass": "generate",
+        "counts": counts,
+        "seconds": time.perf_counter() - start,
+        "peak_rss_mb": peak_rss(),
+    }
+
+
+def run_pass(name, path):
+    """Runs one DatabaseMatcher pass and returns its time and peak memory"""
+    from speciminer.databases.citations import init_db
+    from speciminer.matchers import DatabaseMatcher
+
+    install_portal()
+    init_db(path)
+    matcher = DatabaseMatcher()
+    args = [os.path.splitext(path)[0] + ".csv"] if name == "to_csv" else []
+    start = time.perf_counter()
+    # The matchers print progress for every specimen
+    with open(os.devnull, "w") as f, contextlib.redirect_stdout(f):
+        getattr(matcher, name)(*args)
+    return {
+        "pass": name,
+        "seconds": time.perf_counter() - start,
+        "peak_rss_mb": peak_rss(),
+    }
+
+
+def run_in_process(func, *args):
+    """Runs a function in a fresh process so its peak memory is its own"""
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=1, mp_context=context
+    ) as executor:
+        return executor.submit(func, *args).result()
+
+
+def scaling_exponents(results):
+    """Estimates how time for each pass scales between consecutive sizes
+
+    An exponent of 1 means time grows linearly with row count. Exponents
+    well above 1 mean the pass is superlinear.
+
+    Returns:
+        dict mapping (pass, size) to the exponent from the previous size
+    """
+    exponents = {}
+    by_pass = {}
+    for result in results:
+        by_pass.setdefault(result["pass"], []).append(result)
+    for name, rows in by_pass.items():
+        rows.sort(key=lambda r: r["rows"])
+        for prev, curr in zip(rows, rows[1:]):
+            if prev["rows"] != curr["rows"] and prev["seconds"] > 0 and curr["seconds"] > 0:
+                exponents[(name, curr["size"])] = (
+                    math.log(curr["seconds"] / prev["seconds"])
+                    / math.log(curr["rows"] / prev["rows"])
+                )
+    return exponents
+
+
+def plot(results, path):
+    """Plots time and peak memory for each pass against row count"""
+    if plt is None:
+        print("matplotlib is not installed, so no plot was made")
+        return
+
+    fig, (ax_time, ax_mem) = plt.subplots(1, 2, figsize=(12, 5))
+    names = list(dict.fromkeys(r["pass"] for r in results))
+    for name in names:
+        rows = sorted([r for r in results if r["pass"] == name],
+                      key=lambda r: r["rows"])
+        x = [r["rows"] for r in rows]
+        ax_time.plot(x, [r["seconds"] for r in rows], marker="o", label=name)
+        ax_mem.plot(x, [r["peak_rss_mb"] for r in rows], marker="o", label=name)
+
+    for ax, ylabel in ((ax_time, "seconds"), (ax_mem, "peak RSS (MB)")):
+        ax.set_xscale("log")
+        ax.set_yscale("log")
+        ax.set_xlabel("rows")
+        ax.set_ylabel(ylabel)
+        ax.grid(True, which="both", alpha=0.3)
+        ax.legend()
+    ax_time.set_title("Time")
+    ax_mem.set_title("Memory")
+
+    fig.tight_layout()
+    fig.savefig(path)
+    plt.close(fig)
+    print(f"Saved plot to {path}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", nargs="+", default=["1M", "10M", "50M"],
+                        help="approximate number of rows in each database")
+    parser.add_argument("--passes", nargs="+", default=PASSES, choices=PASSES,
+                        help="passes to run, always in production order")
+    parser.add_argument("--dir", default="scale",
+                        help="directory for the generated databases")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed for the generator")
+    parser.add_argument("--regenerate", action="store_true",
+                        help="replace databases that already exist")
+    parser.add_argument("--keep", action="store_true",
+                        help="keep the databases the passes were run on")
+    parser.add_argument("--plot", default="scale.png",
+                        help="path to save the plot to")
+    parser.add_argument("--json", help="path to write results to as JSON")
+    args = parser.parse_args(argv)
+
+    try:
+        sizes = sorted(parse_size(s) for s in args.sizes)
+    except ValueError as exc:
+        parser.error(str(exc))
+    passes = [p for p in PASSES if p in args.passes]
+    os.makedirs(args.dir, exist_ok=True)
+
+    results = []
+    print(f"{'size':>6} {'pass':<20} {'rows':>12} {'seconds':>10}"
+          f" {'peak RSS':>10}")
+    for size in sizes:
+        label = format_size(size)
+        path = os.path.join(args.dir, f"citations-{label}.sqlite")
+        if args.regenerate or not os.path.exists(path):
+            _remove_db(path)
+            result = run_in_process(run_generate, path, size, args.seed)
+            print(f"{label:>6} {'generate':<20} {sum(result['counts'].values()):>12,}"
+                  f" {result['seconds']:>10.1f} {result['peak_rss_mb']:>8.1f}MB")
+        counts = count_rows(path)
+        num_rows = sum(counts.values())
+        print(f"{label:>6} rows: " + ", ".join(f"{k}={v:,}" for k, v in counts.items()))
+
+        # The passes update links, so run them on a copy of the generated
+        # database to keep it reusable
+        work_path = os.path.join(args.dir, f"citations-{label}-work.sqlite")
+        _remove_db(work_path)
+        shutil.copyfile(path, work_path)
+        try:
+            for name in passes:
+                result = run_in_process(run_pass, name, work_path)
+                result.update(size=size, rows=num_rows, counts=counts)
+                results.append(result)
+                print(f"{label:>6} {name:<20} {num_rows:>12,}"
+                      f" {result['seconds']:>10.1f} {result['peak_rss_mb']:>8.1f}MB")
+        finally:
+            if not args.keep:
+                _remove_db(work_path)
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(os.path.splitext(work_path)[0] + ".csv")
+
+    exponents = scaling_exponents(results)
+    if exponents:
+        print("\nScaling exponents (1.0 is linear):")
+        for (name, size), exp in exponents.items():
+            flag = "  superlinear" if exp > 1.2 else ""
+            print(f"  {name:<20} up to {format_size(size):>6}: {exp:.2f}{flag}")
+
+    if args.plot:
+        plot(results, args.plot)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({
+                "args": vars(args),
+                "results": results,
+                "exponents": [{"pass": n, "size": s, "exponent": e}
+                              for (n, s), e in exponents.items()],
+            }, f, indent=2)
+
+
+
+
+def _remove_db(path):
+    """Removes a SQLite database and its journal files if they exist"""
+    for fp in (path, f"{path}-wal", f"{path}-shm"):
+        if os.path.exists(fp):
+            os.remove(fp)
+
+
+def _md5(val):
+    """Returns the MD5 hex digest of a string"""
+    return hashlib.md5(val.encode("utf-8")).hexdigest()
+
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Defines offline stand-ins for the portal and the citations database"""
+import os
+import re
+import tempfile
+import time
+from contextlib import contextmanager
+
+from corpus import specimen_record
+
+
+
+
+class StubPortal:
+    """Returns synthetic portal records instead of querying GeoGallery
+
+    Args:
+        hit_rate (float): fraction of catalog numbers with any records
+        latency (float): seconds to sleep per request to mimic the network
+
+    Attributes:
+        requests (int): number of requests made
+    """
+
+    def __init__(self, hit_rate=0.9, latency=0.0):
+        self.hit_rate = hit_rate
+        self.latency = latency
+        self.requests = 0
+
+
+    def get_specimen_by_id(self, spec_num):
+        """Returns records for a catalog number"""
+        self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        match = re.search(r"\d+", str(spec_num))
+        if match is None:
+            return []
+        num = int(match.group())
+        # Hash the number so misses are spread evenly across departments
+        if (num * 2654435761 % 2 ** 32) / 2 ** 32 >= self.hit_rate:
+            return []
+        # A few numbers are shared by records in more than one department
+        count = 2 if num % 17 == 0 else 1
+        return [specimen_record(num, i) for i in range(count)]
+
+
+
+
+def install_portal(portal=None):
+    """Replaces the portal used by all matchers"""
+    from speciminer.matchers.core import Matcher
+    Matcher.portal = portal if portal is not None else StubPortal()
+    return Matcher.portal
+
+
+@contextmanager
+def temp_citations_db():
+    """Creates an empty citations database in a temporary directory
+
+    Yields:
+        path to the database
+    """
+    from sqlalchemy.orm import close_all_sessions
+    from speciminer.databases.citations import Session, init_db
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "citations.sqlite")
+        init_db(path)
+        try:
+            yield path
+        finally:
+            close_all_sessions()
+            Session.kw["bind"].dispose()
@@ -1,6 +1,10 @@
 """Defines bot to interact with BHL v3 API"""
 import logging
 import re
+import shelve
+import threading
+import time
+from contextlib import contextmanager
 
 from lxml import etree
 
@@ -8,6 +12,8 @@ from nmnh_ms_tools.bots.core import Bot, JSONResponse
 from nmnh_ms_tools.config import CONFIG
 from nmnh_ms_tools.records import Reference
 
+from ..utils import LRUCache, RateLimiter
+
 
 
 
@@ -17,18 +23,67 @@ logger = logging.getLogger(__name__)
 
 
 class BHLBot(Bot):
-    """Defines methods to interact with BHL v3 API"""
+    """Defines methods to interact with BHL v3 API
+
+    Requests made with the same API key share one rate limiter, so bots
+    used from several threads stay within the budget for that key. The
+    limiter is created by the first bot that uses a key.
+
+    Args:
+        api_key (str): the BHL API key. Defaults to the key in the config.
+        rate (float): maximum requests per second for the API key
+        retries (int): number of times to retry a request that fails because
+            of a network error, rate limit, or server error
+        backoff (float): seconds to wait before the first retry. The wait
+            doubles with each retry.
+        cache_size (int): maximum number of titles to keep in memory
+        item_cache_size (int): maximum number of items to keep in memory.
+            Items include the OCR text for every page, so keep this small.
+        cache_path (str): path to a shelve file used to keep titles between
+            runs. Titles are only cached in memory if omitted.
+    """
+    _limiters = {}
+    _limiters_lock = threading.Lock()
 
     def __init__(self, *args, **kwargs):
         self.api_key = kwargs.pop("api_key", CONFIG.bots.bhl_api_key)
         if not self.api_key:
             raise ValueError("BHL API key required")
+        rate = kwargs.pop("rate", 5)
+        self.retries = kwargs.pop("retries", 3)
+        self.backoff = kwargs.pop("backoff", 1.0)
+        with self._limiters_lock:
+            self.limiter = self._limiters.setdefault(
+                self.api_key, RateLimiter(rate)
+            )
+
+        # Serials have thousands of items that share a title, and search
+        # results often include several parts from the same item
+        self.caches = {
+            "title": LRUCache(kwargs.pop("cache_size", 1024)),
+            "item": LRUCache(kwargs.pop("item_cache_size", 8)),
+        }
+        cache_path = kwargs.pop("cache_path", None)
+        self._shelf = shelve.open(cache_path) if cache_path else None
+        self._cache_lock = threading.Lock()
+        self._fetch_locks = {}
+
         kwargs.setdefault("wrapper", BHLResponse)
         super().__init__(*args, **kwargs)
 
 
     def get_item_metadata(self, item_id, **kwargs):
-        """Makes a request to the GetItemMetadata endpoint"""
+        """Makes a request to the GetItemMetadata endpoint
+
+        Responses for the default parameters are cached by item ID.
+        """
+        if not kwargs:
+            return self._cached("item", item_id, self._get_item_metadata, item_id)
+        return self._get_item_metadata(item_id, **kwargs)
+
+
+    def _get_item_metadata(self, item_id, **kwargs):
+        """Makes an uncached request to the GetItemMetadata endpoint"""
         params = {
             "op": "GetItemMetadata",
             "pages": "true",
@@ -65,7 +120,15 @@ class BHLBot(Bot):
 
 
     def get_title_metadata(self, title_id):
-        """Makes a request to the GetTitleMetadata endpoint"""
+        """Makes a request to the GetTitleMetadata endpoint
+
+        Responses are cached by title ID.
+        """
+        return self._cached("title", title_id, self._get_title_metadata, title_id)
+
+
+    def _get_title_metadata(self, title_id):
+        """Makes an uncached request to the GetTitleMetadata endpoint"""
         params = {
             "op": "GetTitleMetadata",
             "id": title_id
@@ -107,8 +170,9 @@ class BHLBot(Bot):
         # FIXME: Importing this at the top creates a circular import
         from nmnh_ms_tools.records import Person, Reference
 
-        # Retrieve basic item metadata
-        item = self.get_item_metadata(item_id)[0]
+        # Retrieve basic item metadata. Copy it so that the title info added
+        # below does not change the cached response.
+        item = dict(self.get_item_metadata(item_id)[0])
 
         # Most bibliographic info for items is kept in the title record,
         # so integrate that into the item
@@ -182,6 +246,77 @@ class BHLBot(Bot):
         return [Reference(pub) for pub in pubs]
 
 
+    def cache_info(self):
+        """Summarizes hits and misses for each cache
+
+        Responses read from the persistent cache count as hits. Misses
+        are responses fetched from BHL.
+        """
+        return {kind: cache.info() for kind, cache in self.caches.items()}
+
+
+    def close(self):
+        """Logs cache stats and closes the persistent cache if open"""
+        for kind, info in self.cache_info().items():
+            logger.info(f"BHL {kind} cache: {info['hits']:,} hits,"
+                        f" {info['misses']:,} misses")
+        with self._cache_lock:
+            if self._shelf is not None:
+                self._shelf.close()
+                self._shelf = None
+
+
+    def _cached(self, kind, key, func, *args):
+        """Returns a cached response, calling func to fetch it if missing
+
+        Threads requesting the same key wait for the first request to
+        finish instead of fetching the response again.
+        """
+        cache = self.caches[kind]
+        with self._fetch_lock(kind, key):
+            val = cache.get(key, count=False)
+
+            # Only titles are persisted because items include the full text
+            shelf_key = f"{kind}:{key}"
+            if val is None and kind == "title" and self._shelf is not None:
+                with self._cache_lock:
+                    val = self._shelf.get(shelf_key)
+                if val is not None:
+                    cache.put(key, val)
+
+            if val is not None:
+                cache.add_counts(1, 0)
+                return val
+
+            # Store a plain list so the response can be pickled
+            val = list(func(*args))
+            cache.put(key, val)
+            cache.add_counts(0, 1)
+            if kind == "title" and self._shelf is not None:
+                with self._cache_lock:
+                    self._shelf[shelf_key] = val
+                    # Titles are fetched rarely, so write them out right
+                    # away in case the run is interrupted
+                    self._shelf.sync()
+            return val
+
+
+    @contextmanager
+    def _fetch_lock(self, kind, key):
+        """Holds a lock for one key, discarding it once no thread needs it"""
+        with self._cache_lock:
+            lock, users = self._fetch_locks.get((kind, key), (threading.Lock(), 0))
+            self._fetch_locks[(kind, key)] = (lock, users + 1)
+        try:
+            with lock:
+                yield
+        finally:
+            with self._cache_lock:
+                lock, users = self._fetch_locks.pop((kind, key))
+                if users > 1:
+                    self._fetch_locks[(kind, key)] = (lock, users - 1)
+
+
     def _query_bhl(self, **kwargs):
         """Queries specified BHL v3 webservice"""
 
@@ -193,7 +328,26 @@ class BHLBot(Bot):
             "format": "json",
         }
         params.update(**kwargs)
-        return self.get("https://www.biodiversitylibrary.org/api3", params=params)
+
+        for attempt in range(self.retries + 1):
+            self.limiter.acquire()
+            try:
+                return self.get("https://www.biodiversitylibrary.org/api3", params=params)
+            except OSError as exc:
+                # Network errors from requests are subclasses of OSError
+                if attempt == self.retries or not self._is_retryable(exc):
+                    raise
+                delay = self.backoff * 2 ** attempt
+                logger.warning(f"BHL request failed ({exc}). Retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+
+    @staticmethod
+    def _is_retryable(exc):
+        """Tests if a failed request should be retried"""
+        # Client errors other than too many requests will fail again
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+        return status is None or status == 429 or status >= 500
 
 
     @staticmethod
@@ -1 +1,7 @@
 from .database import *
+from .compact import compact_db, init_compact_db, open_compact_db
+from .counts import backfill_counts
+from .fts import (
+    disable_fts, enable_fts, has_fts, rebuild_fts, search_snippets
+)
+from .migrations import MIGRATIONS, get_version, migrate
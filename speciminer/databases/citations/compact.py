@@ -0,0 +1,381 @@
+"""Defines a compact version of the citation database
+
+The compact schema replaces the md5 hex keys used for snippets, specimens,
+and links with integer rowids, keeping the md5 digest as a unique 16-byte
+BLOB so records can still be matched idempotently. Snippets and links
+reference documents by integer id instead of by URL. Journals and
+DarwinCore records are copied unchanged.
+
+Use compact_db to convert a database created by init_db, and
+open_compact_db to read a compact database using the original schema.
+"""
+import hashlib
+import logging
+import os
+
+from sqlalchemy import (
+    Column,
+    ForeignKey,
+    Index,
+    Integer,
+    LargeBinary,
+    String,
+    UniqueConstraint,
+    create_engine,
+    event,
+)
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+from .counts import _count_triggers
+from .migrations import MIGRATIONS, get_version
+
+
+
+
+logger = logging.getLogger(__name__)
+CompactBase = declarative_base()
+CompactSession = sessionmaker()
+
+
+
+
+class CompactJournal(CompactBase):
+    __tablename__ = 'journals'
+
+    title = Column(String(collation='nocase'), primary_key=True)
+    topic = Column(String)
+    num_documents = Column(Integer)
+    num_snippets = Column(Integer)
+    num_specimens = Column(Integer)
+
+
+
+
+class CompactDocument(CompactBase):
+    """Stores information about a publication or document"""
+    __tablename__ = 'documents'
+
+    id = Column(Integer, primary_key=True)
+    url = Column(String, nullable=False, unique=True)
+    publication_url = Column(String(collation='nocase'))
+    kind = Column(String(collation='nocase'))
+    authors = Column(String(collation='nocase'))
+    title = Column(String(collation='nocase'))
+    year = Column(String)
+    publication = Column(String(collation='nocase'))
+    volume = Column(String(collation='nocase'))
+    number = Column(String(collation='nocase'))
+    pages = Column(String(collation='nocase'))
+    doi = Column(String)
+    topic = Column(String)
+    num_specimens = Column(Integer)
+    num_snippets = Column(Integer)
+    __table_args__ = (
+        Index('idx_documents_publication', 'publication'),
+    )
+
+
+
+
+class CompactPage(CompactBase):
+    """Stores the compressed text of a page, keyed to the hash of the text"""
+    __tablename__ = 'pages'
+
+    hash = Column(String, primary_key=True)
+    codec = Column(String, nullable=False)
+    content = Column(LargeBinary, nullable=False)
+
+
+
+
+class CompactSnippet(CompactBase):
+    """Stores information about a snippet from a document"""
+    __tablename__ = 'snippets'
+
+    id = Column(Integer, primary_key=True)
+    hash = Column(LargeBinary(16), nullable=False, unique=True)
+    doc_id = Column(Integer, ForeignKey('documents.id'), nullable=False)
+    page_id = Column(String)
+    snippet = Column(String(collation='nocase'))
+    notes = Column(String(collation='nocase'))
+    page_hash = Column(String, ForeignKey('pages.hash'))
+    start_offset = Column(Integer)
+    end_offset = Column(Integer)
+    __table_args__ = (
+        Index('idx_snippets_doc_id', 'doc_id'),
+    )
+
+
+
+
+class CompactSpecimen(CompactBase):
+    """Stores information about a specimen number found in a document"""
+    __tablename__ = 'specimens'
+
+    id = Column(Integer, primary_key=True)
+    hash = Column(LargeBinary(16), nullable=False, unique=True)
+    snippet_id = Column(Integer, ForeignKey('snippets.id'), nullable=False)
+    verbatim = Column(String(collation='nocase'), nullable=False)
+    spec_num = Column(String(collation='nocase'), nullable=False)
+    __table_args__ = (
+        Index('idx_specimens_snippet_id', 'snippet_id'),
+        Index('idx_specimens_spec_num', 'spec_num', 'snippet_id'),
+    )
+
+
+
+
+class CompactLink(CompactBase):
+    """Stores link to a catalog record"""
+    __tablename__ = 'links'
+
+    id = Column(Integer, primary_key=True)
+    hash = Column(LargeBinary(16), nullable=False, unique=True)
+    doc_id = Column(Integer, ForeignKey('documents.id'), nullable=False)
+    verbatim = Column(String(collation='nocase'), nullable=False)
+    spec_num = Column(String(collation='nocase'), nullable=False)
+    ezid = Column(String)
+    match_quality = Column(String(collation='nocase'))
+    department = Column(String(collation='nocase'))
+    has_similar_ref = Column(Integer)
+    num_snippets = Column(Integer)
+    notes = Column(String(collation='nocase'))
+    __table_args__ = (
+        UniqueConstraint('doc_id', 'verbatim', 'spec_num', name='_doc_spec'),
+        Index('idx_links_spec_num_doc_id', 'spec_num', 'doc_id'),
+    )
+
+
+
+
+class CompactDarwinCore(CompactBase):
+    """Stores basic DarwinCore metadata for a catalog record"""
+    __tablename__ = 'dwc'
+
+    id = Column(String, primary_key=True)
+    higher_classification = Column(String(collation='nocase'))
+    scientific_name = Column(String(collation='nocase'))
+    type_status = Column(String(collation='nocase'))
+    higher_geography = Column(String(collation='nocase'))
+    verbatim_locality = Column(String(collation='nocase'))
+
+
+
+
+# Count triggers for tables that reference documents by integer id
+COMPACT_COUNT_TRIGGERS = _count_triggers(
+    "id = {row}.doc_id",
+    "title = (SELECT publication FROM documents WHERE id = {row}.doc_id)",
+    "id = (SELECT doc_id FROM snippets WHERE id = {row}.snippet_id)",
+    (
+        "title = (SELECT d.publication FROM snippets s"
+        " JOIN documents d ON d.id = s.doc_id"
+        " WHERE s.id = {row}.snippet_id)"
+    ),
+)
+
+
+# Views that present a compact database using the tables from init_db
+COMPACT_VIEWS = {
+    "journals": (
+        "SELECT title, topic, num_documents, num_snippets, num_specimens"
+        " FROM compact.journals"
+    ),
+    "documents": (
+        "SELECT url, publication_url, kind, authors, title, year, publication,"
+        " volume, number, pages, doi, topic, num_specimens, num_snippets,"
+        " id AS rowid"
+        " FROM compact.documents"
+    ),
+    "pages": "SELECT hash, codec, content FROM compact.pages",
+    "snippets": (
+        "SELECT lower(hex(s.hash)) AS id, d.url AS doc_url, s.page_id,"
+        " s.snippet, s.notes, s.page_hash, s.start_offset, s.end_offset,"
+        " s.id AS rowid"
+        " FROM compact.snippets s"
+        " JOIN compact.documents d ON d.id = s.doc_id"
+    ),
+    "specimens": (
+        "SELECT lower(hex(sp.hash)) AS id, lower(hex(sn.hash)) AS snippet_id,"
+        " sp.verbatim, sp.spec_num, sp.id AS rowid"
+        " FROM compact.specimens sp"
+        " JOIN compact.snippets sn ON sn.id = sp.snippet_id"
+    ),
+    "links": (
+        "SELECT lower(hex(l.hash)) AS id, d.url AS doc_url, l.verbatim,"
+        " l.spec_num, l.ezid, l.match_quality, l.department,"
+        " l.has_similar_ref, l.num_snippets, l.notes, l.id AS rowid"
+        " FROM compact.links l"
+        " JOIN compact.documents d ON d.id = l.doc_id"
+    ),
+    "dwc": "SELECT * FROM compact.dwc",
+}
+
+
+
+
+def init_compact_db(fp, count_triggers=True):
+    """Creates a compact database at the given path
+
+    Args:
+        fp (str): path to the database
+        count_triggers (bool): whether to create the triggers that keep
+            document and journal counts up to date
+
+    Returns:
+        Engine for the compact database
+    """
+    engine = create_engine(f"sqlite:///{fp}")
+    CompactBase.metadata.create_all(engine)
+    if count_triggers:
+        with engine.begin() as conn:
+            for stmt in COMPACT_COUNT_TRIGGERS.values():
+                conn.exec_driver_sql(stmt)
+    CompactSession.configure(bind=engine)
+    return engine
+
+
+def open_compact_db(fp):
+    """Opens a compact database for reading as if it used the original schema
+
+    The compact database is attached read-only to an in-memory database
+    that defines temporary views named after the tables created by
+    init_db. The views convert integer keys back to md5 hex digests and
+    document URLs, so code that reads from the citations database, like
+    DatabaseMatcher.to_csv, works with the returned engine. Keys that were
+    not md5 hex digests in the source database cannot be recovered.
+
+    Args:
+        fp (str): path to a database created by compact_db
+
+    Returns:
+        Engine for the in-memory database
+    """
+    if not os.path.exists(fp):
+        raise ValueError(f"{fp} does not exist")
+    engine = create_engine("sqlite://")
+
+    @event.listens_for(engine, "connect")
+    def _create_views(dbapi_conn, conn_record):
+        cursor = dbapi_conn.cursor()
+        cursor.execute("ATTACH DATABASE ? AS compact", (f"file:{fp}?mode=ro",))
+        for name, stmt in COMPACT_VIEWS.items():
+            cursor.execute(f"CREATE TEMP VIEW {name} AS {stmt}")
+        cursor.close()
+
+    return engine
+
+
+def compact_db(src, dst):
+    """Copies a citations database into a new database using the compact schema
+
+    The source database is opened read-only and must already be at the
+    current schema version. Use migrate to update older databases.
+
+    Args:
+        src (str): path to an existing citations database
+        dst (str): path to the compact database. Must not exist.
+
+    Returns:
+        Engine for the compact database
+    """
+    if os.path.exists(dst):
+        raise ValueError(f"{dst} already exists")
+    uri = f"file:{src}?mode=ro"
+    src_engine = create_engine(f"sqlite:///{uri}&uri=true")
+    version = get_version(src_engine)
+    src_engine.dispose()
+    latest = MIGRATIONS[-1][0]
+    if version < latest:
+        raise ValueError(f"{src} is at schema version {version} but must be at"
+                         f" version {latest}. Run migrate on it first.")
+
+    # Counts are copied from the source, so the triggers are added once
+    # all the rows are in
+    engine = init_compact_db(dst, count_triggers=False)
+
+    conn = engine.raw_connection()
+    try:
+        conn.create_function("md5_blob", 1, md5_blob)
+        cursor = conn.cursor()
+        cursor.execute("PRAGMA synchronous = OFF")
+        cursor.execute("ATTACH DATABASE ? AS src", (uri,))
+
+        journal_cols = ", ".join(c.name for c in CompactJournal.__table__.columns)
+        cols = [c.name for c in CompactDocument.__table__.columns if c.name != "id"]
+        stmts = [
+            ("journals", (
+                f"INSERT INTO journals ({journal_cols})"
+                f" SELECT {journal_cols} FROM src.journals"
+            )),
+            ("documents", (
+                f"INSERT INTO documents ({', '.join(cols)})"
+                f" SELECT {', '.join(cols)} FROM src.documents ORDER BY url"
+            )),
+            # Add placeholders for documents that are referenced but missing
+            ("documents", (
+                "INSERT INTO documents (url)"
+                " SELECT doc_url FROM src.snippets"
+                " UNION SELECT doc_url FROM src.links"
+                " EXCEPT SELECT url FROM documents"
+            )),
+            ("pages", "INSERT INTO pages SELECT hash, codec, content FROM src.pages"),
+            ("snippets", (
+                "INSERT INTO snippets (hash, doc_id, page_id, snippet, notes,"
+                " page_hash, start_offset, end_offset)"
+                " SELECT md5_blob(s.id), d.id, s.page_id, s.snippet, s.notes,"
+                " s.page_hash, s.start_offset, s.end_offset"
+                " FROM src.snippets s"
+                " JOIN documents d ON d.url = s.doc_url"
+                " ORDER BY d.id, s.page_id"
+            )),
+            ("specimens", (
+                "INSERT INTO specimens (hash, snippet_id, verbatim, spec_num)"
+                " SELECT md5_blob(sp.id), sn.id, sp.verbatim, sp.spec_num"
+                " FROM src.specimens sp"
+                " JOIN snippets sn ON sn.hash = md5_blob(sp.snippet_id)"
+                " ORDER BY sn.id"
+            )),
+            ("links", (
+                "INSERT INTO links (hash, doc_id, verbatim, spec_num, ezid,"
+                " match_quality, department, has_similar_ref, num_snippets, notes)"
+                " SELECT md5_blob(l.id), d.id, l.verbatim, l.spec_num, l.ezid,"
+                " l.match_quality, l.department, l.has_similar_ref,"
+                " l.num_snippets, l.notes"
+                " FROM src.links l"
+                " JOIN documents d ON d.url = l.doc_url"
+            )),
+            ("dwc", "INSERT INTO dwc SELECT * FROM src.dwc"),
+        ]
+        for table, stmt in stmts:
+            logger.info(f"Copying {table} to {dst}")
+            cursor.execute(stmt)
+        for stmt in COMPACT_COUNT_TRIGGERS.values():
+            cursor.execute(stmt)
+        conn.commit()
+
+        # Specimens are dropped if their snippet is missing
+        cursor.execute("SELECT COUNT(*) FROM src.specimens")
+        num_src = cursor.fetchone()[0]
+        cursor.execute("SELECT COUNT(*) FROM specimens")
+        num_dst = cursor.fetchone()[0]
+        if num_src != num_dst:
+            logger.warning(f"{num_src - num_dst:,} specimens without snippets"
+                           f" were not copied")
+        cursor.execute("DETACH DATABASE src")
+        cursor.close()
+    finally:
+        conn.close()
+    return engine
+
+
+def md5_blob(val):
+    """Converts an md5 hex digest to bytes, hashing other values"""
+    try:
+        digest = bytes.fromhex(val)
+    except (TypeError, ValueError):
+        digest = b""
+    if len(digest) != 16:
+        digest = hashlib.md5(str(val).encode("utf-8")).digest()
+    return digest
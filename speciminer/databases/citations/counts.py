@@ -0,0 +1,174 @@
+"""Maintains per-document and per-journal counts of snippets and specimens
+
+Counts are updated by SQLite triggers as rows are inserted or deleted, so
+reports can read them from the documents and journals tables instead of
+aggregating the snippets and specimens tables. Journals are matched to
+documents using the publication field. Use backfill_counts to recalculate
+the counts from scratch.
+"""
+import logging
+
+from sqlalchemy import text
+
+from .models import _get_bind
+
+
+
+
+logger = logging.getLogger(__name__)
+
+
+
+
+# Expressions that find the document and journal for a snippet or specimen
+_DOC_FOR_SNIPPET = "url = {row}.doc_url"
+_JOURNAL_FOR_SNIPPET = (
+    "title = (SELECT publication FROM documents WHERE url = {row}.doc_url)"
+)
+_DOC_FOR_SPECIMEN = (
+    "url = (SELECT doc_url FROM snippets WHERE id = {row}.snippet_id)"
+)
+_JOURNAL_FOR_SPECIMEN = (
+    "title = (SELECT d.publication FROM snippets s"
+    " JOIN documents d ON d.url = s.doc_url"
+    " WHERE s.id = {row}.snippet_id)"
+)
+
+
+def _counter_trigger(name, event, table, row, updates):
+    """Builds a trigger that increments or decrements counters"""
+    stmts = []
+    for target, col, delta, where in updates:
+        stmts.append(
+            f"UPDATE {target} SET {col} = COALESCE({col}, 0) + {delta}"
+            f" WHERE {where.format(row=row)};"
+        )
+    return (f"CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON {table}"
+            f" BEGIN {' '.join(stmts)} END")
+
+
+def _count_triggers(doc_for_snippet, journal_for_snippet,
+                    doc_for_specimen, journal_for_specimen):
+    """Builds the count triggers using the given lookup expressions
+
+    The expressions are passed in so the same triggers can be built for
+    schemas that key documents differently.
+    """
+    return {
+        "snippets_count_ai": _counter_trigger(
+            "snippets_count_ai", "INSERT", "snippets", "new", [
+                ("documents", "num_snippets", 1, doc_for_snippet),
+                ("journals", "num_snippets", 1, journal_for_snippet),
+            ]
+        ),
+        "snippets_count_ad": _counter_trigger(
+            "snippets_count_ad", "DELETE", "snippets", "old", [
+                ("documents", "num_snippets", -1, doc_for_snippet),
+                ("journals", "num_snippets", -1, journal_for_snippet),
+            ]
+        ),
+        "specimens_count_ai": _counter_trigger(
+            "specimens_count_ai", "INSERT", "specimens", "new", [
+                ("documents", "num_specimens", 1, doc_for_specimen),
+                ("journals", "num_specimens", 1, journal_for_specimen),
+            ]
+        ),
+        "specimens_count_ad": _counter_trigger(
+            "specimens_count_ad", "DELETE", "specimens", "old", [
+                ("documents", "num_specimens", -1, doc_for_specimen),
+                ("journals", "num_specimens", -1, journal_for_specimen),
+            ]
+        ),
+        "documents_count_ai": _counter_trigger(
+            "documents_count_ai", "INSERT", "documents", "new", [
+                ("journals", "num_documents", 1, "title = {row}.publication"),
+            ]
+        ),
+        "documents_count_ad": (
+            "CREATE TRIGGER IF NOT EXISTS documents_count_ad"
+            " AFTER DELETE ON documents BEGIN"
+            " UPDATE journals SET"
+            " num_documents = COALESCE(num_documents, 0) - 1,"
+            " num_snippets = COALESCE(num_snippets, 0) - COALESCE(old.num_snippets, 0),"
+            " num_specimens = COALESCE(num_specimens, 0) - COALESCE(old.num_specimens, 0)"
+            " WHERE title = old.publication;"
+            " END"
+        ),
+        # Move counts between journals if the publication changes
+        "documents_count_au": (
+            "CREATE TRIGGER IF NOT EXISTS documents_count_au"
+            " AFTER UPDATE OF publication ON documents"
+            " WHEN old.publication IS NOT new.publication BEGIN"
+            " UPDATE journals SET"
+            " num_documents = COALESCE(num_documents, 0) - 1,"
+            " num_snippets = COALESCE(num_snippets, 0) - COALESCE(old.num_snippets, 0),"
+            " num_specimens = COALESCE(num_specimens, 0) - COALESCE(old.num_specimens, 0)"
+            " WHERE title = old.publication;"
+            " UPDATE journals SET"
+            " num_documents = COALESCE(num_documents, 0) + 1,"
+            " num_snippets = COALESCE(num_snippets, 0) + COALESCE(new.num_snippets, 0),"
+            " num_specimens = COALESCE(num_specimens, 0) + COALESCE(new.num_specimens, 0)"
+            " WHERE title = new.publication;"
+            " END"
+        ),
+    }
+
+
+COUNT_TRIGGERS = _count_triggers(
+    _DOC_FOR_SNIPPET,
+    _JOURNAL_FOR_SNIPPET,
+    _DOC_FOR_SPECIMEN,
+    _JOURNAL_FOR_SPECIMEN,
+)
+
+
+
+
+def create_count_triggers(conn):
+    """Creates the triggers that maintain counts"""
+    for stmt in COUNT_TRIGGERS.values():
+        conn.execute(text(stmt))
+
+
+def drop_count_triggers(conn):
+    """Drops the triggers that maintain counts"""
+    for name in COUNT_TRIGGERS:
+        conn.execute(text(f"DROP TRIGGER IF EXISTS {name}"))
+
+
+def has_count_triggers(conn):
+    """Tests whether the count triggers exist"""
+    names = {r[0] for r in conn.execute(text(
+        "SELECT name FROM sqlite_master WHERE type = 'trigger'"
+    ))}
+    return set(COUNT_TRIGGERS) <= names
+
+
+def backfill_counts(bind=None):
+    """Recalculates counts for all documents and journals"""
+    bind = _get_bind(bind)
+    with bind.begin() as conn:
+        _backfill_counts(conn)
+
+
+def _backfill_counts(conn):
+    """Recalculates counts using the given connection"""
+    logger.info("Counting snippets and specimens in each document")
+    conn.execute(text(
+        "UPDATE documents SET"
+        " num_snippets = (SELECT COUNT(*) FROM snippets"
+        "  WHERE snippets.doc_url = documents.url),"
+        " num_specimens = (SELECT COUNT(*) FROM specimens"
+        "  JOIN snippets ON snippets.id = specimens.snippet_id"
+        "  WHERE snippets.doc_url = documents.url)"
+    ))
+    logger.info("Rolling up counts for each journal")
+    conn.execute(text(
+        "UPDATE journals SET"
+        " num_documents = (SELECT COUNT(*) FROM documents"
+        "  WHERE documents.publication = journals.title),"
+        " num_snippets = (SELECT COALESCE(SUM(num_snippets), 0) FROM documents"
+        "  WHERE documents.publication = journals.title),"
+        " num_specimens = (SELECT COALESCE(SUM(num_specimens), 0) FROM documents"
+        "  WHERE documents.publication = journals.title)"
+    ))
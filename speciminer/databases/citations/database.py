@@ -1,129 +1,44 @@
-"""Defines tables in the citation database"""
+"""Creates and configures the citation database
+
+The tables are defined in models, which are re-exported here.
+"""
 import logging
 import os
+from contextlib import contextmanager
 
-from sqlalchemy import (
-    Column,
-    ForeignKey,
-    Index,
-    Integer,
-    String,
-    UniqueConstraint,
-)
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
 
 from nmnh_ms_tools.config import CONFIG
 from nmnh_ms_tools.databases.helpers import init_helper
 
+from .counts import (
+    _backfill_counts,
+    create_count_triggers,
+    drop_count_triggers,
+    has_count_triggers,
+)
+from .migrations import migrate
+from .models import (
+    Base,
+    Checkpoint,
+    DarwinCore,
+    Document,
+    Journal,
+    Link,
+    MinedPage,
+    Page,
+    SchemaVersion,
+    Session,
+    Snippet,
+    Specimen,
+    _get_bind,
+)
 
 
 
-logger = logging.getLogger(__name__)
-Base = declarative_base()
-Session = sessionmaker()
-
-
-
-
-class Journal(Base):
-    __tablename__ = 'journals'
-
-    title = Column(String(collation='nocase'), primary_key=True)
-    topic = Column(String)
-
-
-
-
-class Document(Base):
-    """Stores information about a publication or document"""
-    __tablename__ = 'documents'
-
-    url = Column(String, primary_key=True)
-    publication_url = Column(String(collation='nocase'))
-    kind = Column(String(collation='nocase'))
-    authors = Column(String(collation='nocase'))
-    title = Column(String(collation='nocase'), ForeignKey('journals.title'))
-    year = Column(String)
-    publication = Column(String(collation='nocase'))
-    volume = Column(String(collation='nocase'))
-    number = Column(String(collation='nocase'))
-    pages = Column(String(collation='nocase'))
-    doi = Column(String)
-    topic = Column(String)
-    num_specimens = Column(Integer)
-    num_snippets = Column(Integer)
-
-
-
-
-class Snippet(Base):
-    """Stores information about a snippet from a document"""
-    __tablename__ = 'snippets'
-
-    id = Column(String, primary_key=True)
-    doc_url = Column(String, ForeignKey('documents.url'), nullable=False)
-    page_id = Column(String)
-    snippet = Column(String(collation='nocase'), nullable=False)
-    notes = Column(String(collation='nocase'))
-    # Ensure that snippets aren't being duplicated
-    __table_args__ = (
-        UniqueConstraint('doc_url', 'page_id', 'snippet', name='_id_snippet'),
-        Index('idx_snippets_doc_url', 'doc_url'),
-        #Index('idx_snippets_page_id', 'page_id')
-    )
-
-
-
-
-class Specimen(Base):
-    """Stores information about a specimen number found in a document"""
-    __tablename__ = 'specimens'
-
-    id = Column(String, primary_key=True)
-    snippet_id = Column(String, ForeignKey('snippets.id'), nullable=False)
-    verbatim = Column(String(collation='nocase'), nullable=False)
-    spec_num = Column(String(collation='nocase'), nullable=False)
-    __table_args__ = (
-        UniqueConstraint('snippet_id', 'verbatim', 'spec_num', name='_spec_snippet'),
-        Index('idx_specimens_snippet_id', 'snippet_id')
-    )
-
-
-
-
-class Link(Base):
-    """Stores link to a catalog record"""
-    __tablename__ = 'links'
-
-    id = Column(String, primary_key=True)
-    doc_url = Column(String, ForeignKey('documents.url'), nullable=False)
-    verbatim = Column(String(collation='nocase'), nullable=False)
-    spec_num = Column(String(collation='nocase'), nullable=False)
-    ezid = Column(String)
-    match_quality = Column(String(collation='nocase'))
-    department = Column(String(collation='nocase'))
-    has_similar_ref = Column(Integer)
-    num_snippets = Column(Integer)
-    notes = Column(String(collation='nocase'))
-    # Ensure that specimens aren't being duplicated
-    __table_args__ = (
-        UniqueConstraint('doc_url', 'verbatim', 'spec_num', name='_doc_spec'),
-    )
-
-
-
-
-class DarwinCore(Base):
-    """Stores basic DarwinCore metadata for a catalog record"""
-    __tablename__ = 'dwc'
 
-    id = Column(String, primary_key=True)
-    higher_classification = Column(String(collation='nocase'))
-    scientific_name = Column(String(collation='nocase'))
-    type_status = Column(String(collation='nocase'))
-    higher_geography = Column(String(collation='nocase'))
-    verbatim_locality = Column(String(collation='nocase'))
+logger = logging.getLogger(__name__)
 
 
 
@@ -135,3 +50,103 @@ def init_db(fp=None, tables=None):
     if fp is None:
         fp = CONFIG.data.citations
     init_helper(fp, base=Base, session=Session, tables=tables)
+    migrate()
+
+
+
+
+@contextmanager
+def bulk_load(bind=None, cache_size=2000000, mmap_size=2 ** 30, validate=True):
+    """Configures a SQLite citations database for a large initial load
+
+    Switches to WAL journaling, relaxes synchronous writes, enlarges the
+    page cache and memory map for new connections, and drops secondary
+    indexes and count triggers. The indexes are rebuilt and optionally
+    validated on exit, and counts are recalculated.
+    Unique constraints are kept because SQLite cannot drop them without
+    rebuilding their tables and the miners rely on them to skip duplicates.
+
+    Args:
+        bind (sqlalchemy.engine.Engine): the engine for the database.
+            Defaults to the engine bound to Session by init_db.
+        cache_size (int): page cache size in KiB
+        mmap_size (int): maximum number of bytes to memory map
+        validate (bool): whether to run an integrity check on exit
+    """
+    bind = _get_bind(bind)
+    if bind.dialect.name != "sqlite":
+        logger.warning(f"Bulk-load mode not supported by {bind.dialect.name}")
+        yield bind
+        return
+
+    pragmas = {
+        "synchronous": "OFF",
+        "cache_size": -cache_size,
+        "mmap_size": mmap_size,
+        "temp_store": "MEMORY",
+    }
+
+    def set_pragmas(dbapi_conn, conn_record):
+        cursor = dbapi_conn.cursor()
+        for key, val in pragmas.items():
+            cursor.execute(f"PRAGMA {key} = {val}")
+        cursor.close()
+
+    journal_mode = _set_journal_mode(bind, "WAL")
+
+    # Counts are cheaper to recalculate once than to update row by row
+    with bind.begin() as conn:
+        counts = has_count_triggers(conn)
+        if counts:
+            logger.info("Suspending count triggers")
+            drop_count_triggers(conn)
+
+    indexes = [i for t in Base.metadata.sorted_tables for i in t.indexes]
+    for index in indexes:
+        logger.info(f"Dropping index {index.name}")
+        index.drop(bind, checkfirst=True)
+
+    # Discard pooled connections so new connections get the pragmas
+    bind.dispose()
+    event.listen(bind, "connect", set_pragmas)
+    try:
+        yield bind
+    finally:
+        event.remove(bind, "connect", set_pragmas)
+        bind.dispose()
+        for index in indexes:
+            logger.info(f"Rebuilding index {index.name}")
+            index.create(bind, checkfirst=True)
+        if counts:
+            with bind.begin() as conn:
+                create_count_triggers(conn)
+                _backfill_counts(conn)
+        _set_journal_mode(bind, journal_mode)
+        if validate:
+            with bind.connect() as conn:
+                _validate_indexes(conn, indexes)
+
+
+def _set_journal_mode(bind, mode):
+    """Sets the journal mode, returning the previous mode"""
+    with bind.connect() as conn:
+        current = conn.execute("PRAGMA journal_mode").scalar()
+        try:
+            conn.execute(f"PRAGMA journal_mode = {mode}")
+        except OperationalError as exc_info:
+            # Changing to or from WAL fails if other connections are open
+            logger.warning(f"Could not set journal_mode to {mode}: {exc_info}")
+    return current
+
+
+def _validate_indexes(conn, indexes):
+    """Verifies that indexes exist and are consistent with their tables"""
+    names = {r[0] for r in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index'"
+    )}
+    missing = [i.name for i in indexes if i.name not in names]
+    if missing:
+        raise ValueError(f"Indexes missing after bulk load: {missing}")
+    result = [r[0] for r in conn.execute("PRAGMA integrity_check")]
+    if result != ["ok"]:
+        raise ValueError(f"Integrity check failed: {result}")
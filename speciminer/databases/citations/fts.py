@@ -0,0 +1,145 @@
+"""Defines an optional SQLite FTS5 index over snippets
+
+The index uses snippets as an external content table, so the text is not
+stored twice. Rows are linked by the rowid of the snippets table, which
+VACUUM may renumber, so run rebuild_fts after vacuuming the database.
+
+Only text in the snippet column is indexed, so the index cannot be used
+with snippets stored as offsets into the pages table. enable_fts refuses
+databases that contain such snippets, and Miner.mine refuses to store
+pages in a database that has the index.
+"""
+import logging
+
+from sqlalchemy import text
+
+from .models import Document, Session, Snippet, _get_bind
+
+
+
+
+logger = logging.getLogger(__name__)
+
+
+
+
+FTS_SCHEMA = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS snippets_fts USING fts5(
+        snippet,
+        content='snippets',
+        content_rowid='rowid',
+        tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS snippets_fts_ai AFTER INSERT ON snippets
+    BEGIN
+        INSERT INTO snippets_fts (rowid, snippet)
+        VALUES (new.rowid, new.snippet);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS snippets_fts_ad AFTER DELETE ON snippets
+    BEGIN
+        INSERT INTO snippets_fts (snippets_fts, rowid, snippet)
+        VALUES ('delete', old.rowid, old.snippet);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS snippets_fts_au AFTER UPDATE ON snippets
+    BEGIN
+        INSERT INTO snippets_fts (snippets_fts, rowid, snippet)
+        VALUES ('delete', old.rowid, old.snippet);
+        INSERT INTO snippets_fts (rowid, snippet)
+        VALUES (new.rowid, new.snippet);
+    END""",
+]
+
+
+
+
+def enable_fts(bind=None, rebuild=True):
+    """Creates the full-text index and the triggers that keep it in sync
+
+    Args:
+        bind (sqlalchemy.engine.Engine): the engine for the database.
+            Defaults to the engine bound to Session by init_db.
+        rebuild (bool): whether to index snippets already in the database
+
+    Raises:
+        ValueError: if any snippets are stored as offsets into pages
+    """
+    bind = _get_bind(bind)
+    with bind.connect() as conn:
+        offsets = conn.execute(text(
+            "SELECT 1 FROM snippets"
+            " WHERE snippet IS NULL AND page_hash IS NOT NULL LIMIT 1"
+        )).first()
+    if offsets:
+        raise ValueError("Cannot index snippets stored as offsets into pages")
+    with bind.begin() as conn:
+        for stmt in FTS_SCHEMA:
+            conn.execute(text(stmt))
+    if rebuild:
+        rebuild_fts(bind)
+
+
+def has_fts(bind=None):
+    """Tests whether the full-text index exists"""
+    bind = _get_bind(bind)
+    with bind.connect() as conn:
+        return bool(conn.execute(text(
+            "SELECT 1 FROM sqlite_master"
+            " WHERE type = 'table' AND name = 'snippets_fts'"
+        )).first())
+
+
+def disable_fts(bind=None):
+    """Drops the full-text index and its triggers"""
+    bind = _get_bind(bind)
+    with bind.begin() as conn:
+        for suffix in ("ai", "ad", "au"):
+            conn.execute(text(f"DROP TRIGGER IF EXISTS snippets_fts_{suffix}"))
+        conn.execute(text("DROP TABLE IF EXISTS snippets_fts"))
+
+
+def rebuild_fts(bind=None):
+    """Rebuilds the full-text index from the snippets table"""
+    bind = _get_bind(bind)
+    logger.info("Rebuilding full-text index on snippets")
+    with bind.begin() as conn:
+        conn.execute(text(
+            "INSERT INTO snippets_fts (snippets_fts) VALUES ('rebuild')"
+        ))
+
+
+def search_snippets(query, limit=100, session=None):
+    """Searches snippets using the full-text index
+
+    Args:
+        query (str): an FTS5 query, for example "smithsonian AND holotype"
+        limit (int): maximum number of results to return
+        session (sqlalchemy.orm.Session): session used to load records.
+            Defaults to a new session that is closed before returning.
+
+    Returns:
+        List of (Snippet, Document, score) tuples ordered from best to worst
+        match. Lower bm25 scores are better.
+    """
+    close = session is None
+    if close:
+        session = Session()
+    try:
+        rows = session.execute(text(
+            "SELECT snippets.id, bm25(snippets_fts) AS score"
+            " FROM snippets_fts"
+            " JOIN snippets ON snippets.rowid = snippets_fts.rowid"
+            " WHERE snippets_fts MATCH :query"
+            " ORDER BY score"
+            " LIMIT :limit"
+        ), {"query": query, "limit": limit}).fetchall()
+        ids = [r.id for r in rows]
+        records = {}
+        if ids:
+            results = session.query(Snippet, Document) \
+                             .outerjoin(Document, Snippet.doc_url == Document.url) \
+                             .filter(Snippet.id.in_(ids))
+            records = {snippet.id: (snippet, doc) for snippet, doc in results}
+        return [records[r.id] + (r.score,) for r in rows if r.id in records]
+    finally:
+        if close:
+            session.close()
@@ -0,0 +1,168 @@
+"""Defines versioned schema migrations for the citation database
+
+Each migration is a (version, description, function) tuple. Functions
+receive a connection and should be idempotent because init_db runs all
+migrations against newly created databases, where create_all may already
+have built some of the objects they add.
+"""
+import datetime as dt
+import logging
+
+from sqlalchemy import func, inspect, select
+from sqlalchemy.schema import CreateTable
+
+from .counts import _backfill_counts, create_count_triggers
+from .models import (
+    Checkpoint, MinedPage, Page, SchemaVersion, Snippet, _get_bind
+)
+
+
+
+
+logger = logging.getLogger(__name__)
+
+
+
+
+def add_lookup_indexes(conn):
+    """Indexes columns used to group and filter records by DatabaseMatcher"""
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_specimens_spec_num"
+        " ON specimens (spec_num, snippet_id)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_links_spec_num_doc_url"
+        " ON links (spec_num, doc_url)"
+    )
+
+
+def add_counts(conn):
+    """Maintains snippet and specimen counts for documents and journals"""
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(journals)")}
+    for col in ("num_documents", "num_snippets", "num_specimens"):
+        if col not in cols:
+            conn.execute(f"ALTER TABLE journals ADD COLUMN {col} INTEGER")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_documents_publication"
+        " ON documents (publication)"
+    )
+    create_count_triggers(conn)
+    _backfill_counts(conn)
+
+
+def add_pages(conn):
+    """Allows snippets to be stored as offsets into a compressed page"""
+    Page.__table__.create(conn, checkfirst=True)
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(snippets)")}
+    if "page_hash" not in cols:
+        # SQLite cannot drop the NOT NULL constraint on the snippet column,
+        # so the table has to be rebuilt
+        rebuild_table(conn, Snippet.__table__)
+
+
+def add_checkpoints(conn):
+    """Stores checkpoints so that long mining runs can be resumed"""
+    Checkpoint.__table__.create(conn, checkfirst=True)
+
+
+def add_mined_pages(conn):
+    """Records mined pages so that unchanged pages can be skipped"""
+    MinedPage.__table__.create(conn, checkfirst=True)
+
+
+def drop_doi_index(conn):
+    """Drops the index on documents.doi, which no query uses"""
+    conn.execute("DROP INDEX IF EXISTS idx_documents_doi")
+
+
+def rebuild_table(conn, table):
+    """Rebuilds a table to match its model, keeping rowids and triggers
+
+    Follows the procedure for making arbitrary schema changes described
+    at https://www.sqlite.org/lang_altertable.html. Only columns that
+    exist in both the old and new versions of the table are copied.
+    """
+    name = table.name
+    tmp_name = f"new_{name}"
+    saved = [r[0] for r in conn.execute(
+        "SELECT sql FROM sqlite_master"
+        " WHERE tbl_name = ? AND type IN ('index', 'trigger')"
+        " AND sql IS NOT NULL", (name,)
+    )]
+    old_cols = {r[1] for r in conn.execute(f"PRAGMA table_info({name})")}
+    cols = ", ".join(["rowid"] + [c.name for c in table.columns
+                                  if c.name in old_cols])
+
+    ddl = str(CreateTable(table).compile(conn)).strip()
+    ddl = ddl.replace(f"CREATE TABLE {name} ", f"CREATE TABLE {tmp_name} ", 1)
+    conn.execute(ddl)
+    conn.execute(f"INSERT INTO {tmp_name} ({cols}) SELECT {cols} FROM {name}")
+    conn.execute(f"DROP TABLE {name}")
+
+    # Triggers on other tables that use this table are invalid until the
+    # rename is complete, which makes the rename fail unless the legacy
+    # behavior is enabled
+    conn.execute("PRAGMA legacy_alter_table = ON")
+    conn.execute(f"ALTER TABLE {tmp_name} RENAME TO {name}")
+    conn.execute("PRAGMA legacy_alter_table = OFF")
+
+    for stmt in saved:
+        conn.execute(stmt)
+    for index in table.indexes:
+        index.create(conn, checkfirst=True)
+
+
+
+
+MIGRATIONS = [
+    (1, "Add indexes for matcher lookups", add_lookup_indexes),
+    (2, "Add document and journal counts", add_counts),
+    (3, "Store snippets as offsets into compressed pages", add_pages),
+    (4, "Add checkpoints for resuming mining runs", add_checkpoints),
+    (5, "Record mined pages for incremental re-mining", add_mined_pages),
+    (6, "Drop unused index on document DOIs", drop_doi_index),
+]
+
+
+
+
+def get_version(bind=None):
+    """Returns the current schema version of the database
+
+    Databases without a schema_version table are at version 0. The
+    database is not modified, so this works on read-only connections.
+    """
+    bind = _get_bind(bind)
+    if not inspect(bind).has_table(SchemaVersion.__tablename__):
+        return 0
+    with bind.connect() as conn:
+        version = conn.execute(select([func.max(SchemaVersion.version)])).scalar()
+    return version or 0
+
+
+def migrate(bind=None, target=None):
+    """Applies pending migrations in order
+
+    Args:
+        bind (sqlalchemy.engine.Engine): the engine for the database.
+            Defaults to the engine bound to Session by init_db.
+        target (int): the version to migrate to. Defaults to the latest.
+
+    Returns:
+        Schema version after migrating
+    """
+    bind = _get_bind(bind)
+    SchemaVersion.__table__.create(bind, checkfirst=True)
+    version = get_version(bind)
+    for num, description, migration in MIGRATIONS:
+        if version < num and (target is None or num <= target):
+            logger.info(f"Applying migration {num}: {description}")
+            with bind.begin() as conn:
+                migration(conn)
+                conn.execute(SchemaVersion.__table__.insert().values(
+                    version=num,
+                    description=description,
+                    applied=dt.datetime.now().isoformat(),
+                ))
+            version = num
+    return version
@@ -0,0 +1,253 @@
+"""Defines tables in the citation database"""
+import zlib
+
+from sqlalchemy import (
+    Column,
+    ForeignKey,
+    Index,
+    Integer,
+    LargeBinary,
+    String,
+    UniqueConstraint,
+)
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import relationship, sessionmaker
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+
+
+Base = declarative_base()
+Session = sessionmaker()
+
+
+
+
+class Journal(Base):
+    __tablename__ = 'journals'
+
+    title = Column(String(collation='nocase'), primary_key=True)
+    topic = Column(String)
+    num_documents = Column(Integer)
+    num_snippets = Column(Integer)
+    num_specimens = Column(Integer)
+
+
+
+
+class Document(Base):
+    """Stores information about a publication or document"""
+    __tablename__ = 'documents'
+
+    url = Column(String, primary_key=True)
+    publication_url = Column(String(collation='nocase'))
+    kind = Column(String(collation='nocase'))
+    authors = Column(String(collation='nocase'))
+    title = Column(String(collation='nocase'), ForeignKey('journals.title'))
+    year = Column(String)
+    publication = Column(String(collation='nocase'))
+    volume = Column(String(collation='nocase'))
+    number = Column(String(collation='nocase'))
+    pages = Column(String(collation='nocase'))
+    doi = Column(String)
+    topic = Column(String)
+    num_specimens = Column(Integer)
+    num_snippets = Column(Integer)
+    __table_args__ = (
+        Index('idx_documents_publication', 'publication'),
+    )
+
+
+
+
+class Page(Base):
+    """Stores the compressed text of a page, keyed to the hash of the text"""
+    __tablename__ = 'pages'
+
+    hash = Column(String, primary_key=True)
+    codec = Column(String, nullable=False)
+    content = Column(LargeBinary, nullable=False)
+
+
+    @property
+    def text(self):
+        """Decompresses the text of the page"""
+        try:
+            return self._text
+        except AttributeError:
+            if self.codec == "zstd":
+                if zstandard is None:
+                    raise ValueError("zstandard required to read zstd pages")
+                text = zstandard.ZstdDecompressor().decompress(self.content)
+            else:
+                text = zlib.decompress(self.content)
+            self._text = text.decode("utf-8")
+            return self._text
+
+
+    @staticmethod
+    def compress(text, codec="zlib"):
+        """Compresses text using the given codec"""
+        text = text.encode("utf-8")
+        if codec == "zstd":
+            if zstandard is None:
+                raise ValueError("zstandard required to write zstd pages")
+            return zstandard.ZstdCompressor().compress(text)
+        if codec == "zlib":
+            return zlib.compress(text)
+        raise ValueError(f"Invalid codec: {codec}")
+
+
+
+
+class Snippet(Base):
+    """Stores information about a snippet from a document
+
+    The text of a snippet is stored either in the snippet column or as
+    offsets into a page in the pages table. Use the text property to get
+    the text either way.
+    """
+    __tablename__ = 'snippets'
+    # Columns that say where the text is stored. Upserts replace these
+    # together so a row never has both text and offsets.
+    _upsert_replace = ("snippet", "page_hash", "start_offset", "end_offset")
+
+    id = Column(String, primary_key=True)
+    doc_url = Column(String, ForeignKey('documents.url'), nullable=False)
+    page_id = Column(String)
+    snippet = Column(String(collation='nocase'))
+    notes = Column(String(collation='nocase'))
+    page_hash = Column(String, ForeignKey('pages.hash'))
+    start_offset = Column(Integer)
+    end_offset = Column(Integer)
+    page = relationship("Page", lazy="select")
+    # Ensure that snippets aren't being duplicated
+    __table_args__ = (
+        UniqueConstraint('doc_url', 'page_id', 'snippet', name='_id_snippet'),
+        Index('idx_snippets_doc_url', 'doc_url'),
+        #Index('idx_snippets_page_id', 'page_id')
+    )
+
+
+    @property
+    def text(self):
+        """Returns the text of the snippet, reading it from the page if needed"""
+        if self.snippet is None and self.page_hash:
+            return self.page.text[self.start_offset:self.end_offset]
+        return self.snippet
+
+
+
+
+class Specimen(Base):
+    """Stores information about a specimen number found in a document"""
+    __tablename__ = 'specimens'
+
+    id = Column(String, primary_key=True)
+    snippet_id = Column(String, ForeignKey('snippets.id'), nullable=False)
+    verbatim = Column(String(collation='nocase'), nullable=False)
+    spec_num = Column(String(collation='nocase'), nullable=False)
+    __table_args__ = (
+        UniqueConstraint('snippet_id', 'verbatim', 'spec_num', name='_spec_snippet'),
+        Index('idx_specimens_snippet_id', 'snippet_id'),
+        Index('idx_specimens_spec_num', 'spec_num', 'snippet_id'),
+    )
+
+
+
+
+class Link(Base):
+    """Stores link to a catalog record"""
+    __tablename__ = 'links'
+
+    id = Column(String, primary_key=True)
+    doc_url = Column(String, ForeignKey('documents.url'), nullable=False)
+    verbatim = Column(String(collation='nocase'), nullable=False)
+    spec_num = Column(String(collation='nocase'), nullable=False)
+    ezid = Column(String)
+    match_quality = Column(String(collation='nocase'))
+    department = Column(String(collation='nocase'))
+    has_similar_ref = Column(Integer)
+    num_snippets = Column(Integer)
+    notes = Column(String(collation='nocase'))
+    # Ensure that specimens aren't being duplicated
+    __table_args__ = (
+        UniqueConstraint('doc_url', 'verbatim', 'spec_num', name='_doc_spec'),
+        Index('idx_links_spec_num_doc_url', 'spec_num', 'doc_url'),
+    )
+
+
+
+
+class DarwinCore(Base):
+    """Stores basic DarwinCore metadata for a catalog record"""
+    __tablename__ = 'dwc'
+
+    id = Column(String, primary_key=True)
+    higher_classification = Column(String(collation='nocase'))
+    scientific_name = Column(String(collation='nocase'))
+    type_status = Column(String(collation='nocase'))
+    higher_geography = Column(String(collation='nocase'))
+    verbatim_locality = Column(String(collation='nocase'))
+
+
+
+
+class SchemaVersion(Base):
+    """Stores the schema migrations applied to the database"""
+    __tablename__ = 'schema_version'
+
+    version = Column(Integer, primary_key=True)
+    description = Column(String)
+    applied = Column(String)
+
+
+
+
+class Checkpoint(Base):
+    """Stores the position of a mining run so that it can be resumed
+
+    Checkpoints are committed in the same transaction as the records mined
+    before them, so a resumed run never skips records that were not saved.
+    """
+    __tablename__ = 'checkpoints'
+
+    key = Column(String, primary_key=True)
+    source = Column(String)
+    state = Column(String)
+    updated = Column(String)
+
+
+
+
+class MinedPage(Base):
+    """Records the text and parser version used to mine a page
+
+    Used to skip pages that have not changed since they were last mined
+    and to remove snippets and specimens that a page no longer produces.
+    """
+    __tablename__ = 'mined_pages'
+
+    id = Column(String, primary_key=True)
+    doc_url = Column(String, ForeignKey('documents.url'), nullable=False)
+    page_id = Column(String)
+    text_hash = Column(String, nullable=False)
+    parser_version = Column(String, nullable=False)
+    snippet_ids = Column(String)
+    specimen_ids = Column(String)
+    updated = Column(String)
+
+
+
+
+def _get_bind(bind=None):
+    """Returns the given engine or the engine bound to Session"""
+    if bind is None:
+        bind = Session.kw.get("bind")
+    if bind is None:
+        raise ValueError("No database bound to Session. Run init_db first.")
+    return bind
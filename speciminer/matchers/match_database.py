@@ -5,15 +5,18 @@ import logging
 import re
 
 import pandas as pd
+from sqlalchemy import literal_column, or_
 
 from nmnh_ms_tools.records import (
-    CatNum, CatNums, Citation, People, Reference, Specimen, get_author_and_year
+    CatNum, Citation, People, Reference, Specimen, get_author_and_year
 )
 from nmnh_ms_tools.utils import as_list
 
 from .core import Matcher
-from ..databases.citations import Session, DarwinCore, Link
-from ..utils import SessionWrapper
+from ..databases.citations import (
+    Session, DarwinCore, Document, Link, Page, Snippet, Specimen as MinedSpecimen
+)
+from ..utils import SessionWrapper, parse_catnum, parse_catnums
 
 
 
@@ -41,9 +44,9 @@ class DatabaseMatcher(Matcher):
         """Matches specimen numbers in database to catalog records"""
         session = self.session
 
-        documents = pd.read_sql_table("documents", con=self.session.bind, index_col="url")
-        snippets = pd.read_sql_table("snippets", con=self.session.bind, index_col="id")
-        specimens = pd.read_sql_table("specimens", con=self.session.bind, index_col="id")
+        documents = self.read_table(Document, index_col="url")
+        snippets = self.read_snippets()
+        specimens = self.read_table(MinedSpecimen, index_col="id")
 
         # Add doc_url column to specimens
         specimens = specimens.join(snippets, on="snippet_id") \
@@ -61,7 +64,7 @@ class DatabaseMatcher(Matcher):
             if len(spec_num) > 9 and spec_num[:4] in {"NMNH", "USNM"}:
 
                 try:
-                    spec_nums = CatNums([spec_num])
+                    spec_nums = parse_catnums([spec_num])
                 except ValueError as exc_info:
                     # Skip catalog numbers that can't be parsed using the basic
                     # parser. NOTE: These mostly appear to be type numbers.
@@ -104,15 +107,15 @@ class DatabaseMatcher(Matcher):
     def match_from_snippets(self):
         """Matches records using specimens that occur in the same snippets"""
 
-        documents = pd.read_sql_table("documents", con=self.session.bind, index_col="url")
-        links = pd.read_sql_table("links", con=self.session.bind, index_col="id")
+        documents = self.read_table(Document, index_col="url")
+        links = self.read_table(Link, index_col="id")
 
         links = links.join(
             documents, on="doc_url", lsuffix="links", rsuffix="docs"
         )
 
-        specimens = pd.read_sql_table("specimens", con=self.session.bind, index_col="id")
-        snippets = pd.read_sql_table("snippets", con=self.session.bind, index_col="id")
+        specimens = self.read_table(MinedSpecimen, index_col="id")
+        snippets = self.read_snippets()
         specimens = specimens.join(snippets, on="snippet_id")
 
         for doc_url, rows in links.groupby(links.doc_url):
@@ -193,7 +196,7 @@ class DatabaseMatcher(Matcher):
                         row.spec_num,
                         sources,
                         dept=depts[0],
-                        spec_nums=CatNums([row.spec_num])
+                        spec_nums=parse_catnums([row.spec_num.verbatim])
                     )
 
                     matches = self.best_matches(matches)
@@ -223,8 +226,8 @@ class DatabaseMatcher(Matcher):
     def match_from_ranges(self):
         """Matches records using catalog number ranges from the same document"""
 
-        documents = pd.read_sql_table("documents", con=self.session.bind, index_col="url")
-        links = pd.read_sql_table("links", con=self.session.bind, index_col="id")
+        documents = self.read_table(Document, index_col="url")
+        links = self.read_table(Link, index_col="id")
 
         links = links.join(
             documents, on="doc_url", lsuffix="links", rsuffix="docs"
@@ -388,7 +391,7 @@ class DatabaseMatcher(Matcher):
                                 row.spec_num,
                                 sources,
                                 dept=dept,
-                                spec_nums=CatNums([row.spec_num])
+                                spec_nums=parse_catnums([row.spec_num.verbatim])
                             )
 
                             matches = self.best_matches(matches)
@@ -415,6 +418,72 @@ class DatabaseMatcher(Matcher):
         self.session.close()
 
 
+    def read_table(self, model, index_col=None):
+        """Reads the columns defined by a model into a DataFrame
+
+        Unlike pd.read_sql_table, this also reads from views, like the
+        ones used to read compact databases.
+        """
+        return pd.read_sql(model.__table__.select(),
+                           con=self.session.bind,
+                           index_col=index_col)
+
+
+    def read_snippets(self, chunk_size=500):
+        """Reads snippets, rebuilding text stored as offsets into pages"""
+        snippets = self.read_table(Snippet, index_col="id")
+        if "page_hash" not in snippets:
+            return snippets
+
+        stored = snippets[snippets.snippet.isnull() & snippets.page_hash.notnull()]
+        hashes = list(stored.page_hash.unique())
+        for i in range(0, len(hashes), chunk_size):
+            chunk = hashes[i:i + chunk_size]
+            pages = {p.hash: p for p in self.session.query(Page)
+                                                   .filter(Page.hash.in_(chunk))}
+            rows = stored[stored.page_hash.isin(chunk)]
+            snippets.loc[rows.index, "snippet"] = [
+                pages[r.page_hash].text[int(r.start_offset):int(r.end_offset)]
+                for r in rows.itertuples()
+            ]
+            # Detach pages so their decompressed text can be freed
+            self.session.expunge_all()
+        return snippets
+
+
+    def read_specimens(self, prefixes):
+        """Reads specimens with catalog numbers starting with given prefixes
+
+        The prefixes are matched in SQL so that only matching rows are
+        read from the spec_num index. LIKE ignores case on that column, so
+        the results are filtered again to keep the match case-sensitive.
+        Rows are returned in the order they were inserted.
+        """
+        stmt = MinedSpecimen.__table__.select().where(
+            or_(*[MinedSpecimen.spec_num.like(f"{p}%") for p in prefixes])
+        ).order_by(literal_column("rowid"))
+        specimens = pd.read_sql(stmt, con=self.session.bind, index_col="id")
+        return specimens[specimens.spec_num.str.startswith(tuple(prefixes))]
+
+
+    def read_links(self, prefixes):
+        """Reads links for catalog numbers starting with given prefixes
+
+        Returns a dict mapping (spec_num, doc_url) to the columns of the
+        first link inserted for that pair. Keys are compared in Python, so
+        lookups are case-sensitive even though spec_num ignores case in
+        the database.
+        """
+        stmt = Link.__table__.select().where(
+            or_(*[Link.spec_num.like(f"{p}%") for p in prefixes])
+        ).order_by(literal_column("rowid"))
+        links = {}
+        for result in self.session.execute(stmt):
+            link = {k: v for k, v in result._mapping.items() if k != "id"}
+            links.setdefault((link["spec_num"], link["doc_url"]), link)
+        return links
+
+
     def summarize_specimens(self, rows):
         """Summarizes key metadata from list of records
 
@@ -552,28 +621,24 @@ class DatabaseMatcher(Matcher):
     def to_csv(self, path):
         """Exports snippets and matches to a CSV"""
 
-        documents = pd.read_sql_table("documents", con=self.session.bind, index_col="url")
-        snippets = pd.read_sql_table("snippets", con=self.session.bind, index_col="id")
-        specimens = pd.read_sql_table("specimens", con=self.session.bind, index_col="id")
+        documents = self.read_table(Document, index_col="url")
+        snippets = self.read_snippets()
 
-        # Ditch the index column so the id field is accessible for querying
-        dwc = pd.read_sql_table("dwc", con=self.session.bind)
+        # Limit to USNM specimen numbers
+        specimens = self.read_specimens(("NMNH", "USNM"))
+        links = self.read_links(("NMNH", "USNM"))
 
-        links = pd.read_sql_table("links", con=self.session.bind, index_col="id")
+        # Ditch the index column so the id field is accessible for querying
+        dwc = self.read_table(DarwinCore)
 
         # Add doc_url column to specimens
         specimens = specimens.join(snippets, on="snippet_id") \
                              .join(documents, on="doc_url")
 
-        # Limit to USNM specimen numbers
-        specimens = specimens[specimens.spec_num.str.startswith(("NMNH", "USNM"))]
-
         output = []
         for (spec_num, doc_url), rows in specimens.groupby([specimens.spec_num, specimens.doc_url]):
             try:
-                link, ref, snippets = self._get_links(
-                    rows, links, spec_num, doc_url
-                )
+                link, ref, snippets = self._get_links(rows, links, spec_num, doc_url)
             except ValueError:
                 pass
             else:
@@ -627,10 +692,10 @@ class DatabaseMatcher(Matcher):
 
     def report(self, source):
         """Compiles a list of citations keyed to specimen"""
-        documents = pd.read_sql_table("documents", con=self.session.bind, index_col="url")
-        snippets = pd.read_sql_table("snippets", con=self.session.bind, index_col="id")
-        specimens = pd.read_sql_table("specimens", con=self.session.bind, index_col="id")
-        links = pd.read_sql_table("links", con=self.session.bind, index_col="id")
+        documents = self.read_table(Document, index_col="url")
+        snippets = self.read_snippets()
+        specimens = self.read_specimens(("NMNH", "USNM"))
+        links = self.read_links(("NMNH", "USNM"))
 
         # FIXME: Cannot reproduce the two-part join with links in pandas
         #   SELECT documents.url, documents.title, specimens.spec_num, links.ezid, links.department, snippets.snippet
@@ -646,16 +711,13 @@ class DatabaseMatcher(Matcher):
         # Items are problematic so limit to parts
         specimens = specimens[
             specimens.doc_url.str.startswith("https://biodiversitylibrary.org/part/")
-            & specimens.spec_num.str.startswith(("NMNH", "USNM"))
         ]
 
         citations = {}
         results = {}
         for (spec_num, doc_url), rows in specimens.groupby([specimens.spec_num, specimens.doc_url]):
             try:
-                link, ref, snippets = self._get_links(
-                    rows, links, spec_num, doc_url
-                )
+                link, ref, snippets = self._get_links(rows, links, spec_num, doc_url)
                 if not link.ezid:
                     raise ValueError
             except ValueError:
@@ -687,9 +749,8 @@ class DatabaseMatcher(Matcher):
     def _get_links(self, rows, links, spec_num, doc_url):
         """Finds links matching a given specimen number and document"""
         try:
-            link = links[(links.spec_num == spec_num)
-                         & (links.doc_url == doc_url)].iloc[0]
-        except IndexError:
+            link = pd.Series(links[(spec_num, doc_url)])
+        except KeyError:
             raise ValueError("No linked record found")
         else:
             snippets = {}
@@ -719,7 +780,7 @@ class DatabaseMatcher(Matcher):
         missed = []
         for _, row in rows.iterrows():
             try:
-                row.spec_num = CatNum(row.spec_num)
+                row.spec_num = parse_catnum(row.spec_num)
             except ValueError:
                 pass
             else:
@@ -1,4 +1,4 @@
-from .core import Miner
+from .core import Miner, Pipeline, SourceItem, TextPage
 from .bhl import BHLMiner
 from .geodeepdive import GeoDeepDiveMiner
 from .jstor import JSTORMiner
@@ -1,11 +1,13 @@
 """Defines functions used to mine the BHL corpus"""
 import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from nmnh_ms_tools.records import Reference
 
-from .core import Miner
+from .core import Miner, SourceItem, TextPage
 from ..bots import BHLBot
-from ..databases.citations import Document
+from ..databases.citations import Document, Session
 
 
 
@@ -16,18 +18,116 @@ logger = logging.getLogger(__name__)
 
 
 class BHLMiner(Miner):
-    """Tools for mining specimen numbers from the BHL corpus"""
+    """Tools for mining specimen numbers from the BHL corpus
+
+    Attributes:
+        fetch_workers (int): number of search results to resolve at once.
+            Requests from all threads share the rate limit of the bot.
+    """
 
     def __init__(self):
         super().__init__()
         self.bot = BHLBot()
         self.source = "BHL"
-
-
-    def mine(self, terms, maxpage=None, **kwargs):
-        """Mines specimen numbers from the BHL corpus"""
+        self.fetch_workers = 1
+
+
+    def close(self):
+        """Closes the bot and shuts down the miner"""
+        self.bot.close()
+        super().close()
+
+
+    def iter_source(self, terms, maxpage=None, state=None, **kwargs):
+        """Yields publications and their pages from the BHL corpus
+
+        The checkpoint for each publication is the result page and the index
+        of the next record on that page.
+        """
+        # Reads use their own session because the source runs on its own
+        # thread while records are written from the main thread
+        session = Session()
+        try:
+            yield from self._iter_source(session, terms, maxpage, state, **kwargs)
+        finally:
+            session.close()
+
+
+    def existing_urls(self, session, urls, chunk_size=500):
+        """Returns the subset of URLs already in the documents table
+
+        Args:
+            session (sqlalchemy.orm.Session): the session used to query
+            urls (list of str): document URLs
+            chunk_size (int): maximum number of URLs per query
+
+        Returns:
+            set of existing URLs
+        """
+        urls = list(set(urls))
+        existing = set()
+        for i in range(0, len(urls), chunk_size):
+            query = session.query(Document.url).filter(
+                Document.url.in_(urls[i:i + chunk_size])
+            )
+            existing.update(r.url for r in query)
+        return existing
+
+
+    def fetch_record(self, rec):
+        """Resolves a search result to an item or part
+
+        Returns:
+            Reference for the item or part or None if not found
+        """
+        method = f"get_{rec['BHLType'].lower()}"
+        doc_id = rec[f"{rec['BHLType']}ID"]
+        try:
+            return getattr(self.bot, method)(doc_id)
+        except IndexError:
+            # Fails if full text is unavailable (?)
+            logger.warning(f"{rec['BHLType']}ID={doc_id} not found")
+            return None
+
+
+    def fetch_records(self, records):
+        """Resolves search results to items or parts in order
+
+        Up to fetch_workers records are fetched at once, with a few more
+        queued so the workers stay busy while earlier results are processed.
+
+        Yields:
+            Reference or None for each record
+        """
+        if self.fetch_workers <= 1:
+            for rec in records:
+                yield self.fetch_record(rec)
+            return
+
+        pending = deque()
+        with ThreadPoolExecutor(self.fetch_workers) as executor:
+            try:
+                for rec in records:
+                    pending.append(executor.submit(self.fetch_record, rec))
+                    if len(pending) >= 2 * self.fetch_workers:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                # Drop queued fetches if the caller stops early or one fails
+                for future in pending:
+                    future.cancel()
+
+
+    def _iter_source(self, session, terms, maxpage=None, state=None, **kwargs):
+        """Yields publications and their pages from the BHL corpus"""
         page = kwargs.pop("page", 1)
+        start = 0
+        if state:
+            page = state["page"]
+            start = state["index"]
         # Loop until number of publications found falls below expected
+        existing = set()
         total = 0
         num_records = 200
         while num_records == 200 and (maxpage is None or page <= maxpage):
@@ -47,62 +147,72 @@ class BHLMiner(Miner):
             logger.info(f"Found {num_records} records matching"
                         f" '{terms}' (total={total})")
 
-            # Process each publication based on its URL
-            for rec in records:
-
-                # The publication search returns the best metadata
-                pub = Reference(rec)
-
-                # Skip document if it's already in the database
-                if self.session.query(Document).filter_by(url=pub.url).first():
-                    logger.debug(f"{pub.url} already exists")
-                    continue
-
-                # Otherwise save document so it won't be re-checked
-                pub_id = self.save_document(pub)
-
-                # Resolve record based on type (part or item)
-                method = f"get_{rec['BHLType'].lower()}"
-                doc_id = rec[f"{rec['BHLType']}ID"]
-                try:
-                    doc = getattr(self.bot, method)(doc_id)
-                except IndexError:
-                    # Fails if full text is unavailable (?)
-                    logger.warning(f"{rec['BHLType']}ID={doc_id} not found")
-                    continue
-
-                # Update the publication record based on the part/item
-                if not pub.publication and pub.title != doc.title:
-                    pub.publication = doc.title
-                if pub.url != doc.publication_url:
-                    pub.publication_url = doc.publication_url
-                self.save_document(pub)
-
-                # For items with no parts, use the item itself
-                parts = doc.parts
-                if not parts:
-                    parts = [doc]
-
-                # Look for specimen numbers in each part
-                for part in parts:
-                    if part.url != doc.url:
-                        self.save_document(part)
-                    for page_num, text in part.content.items():
-                        if text:
-                            page_url = f"https://biodiversitylibrary.org/page/{page_num}"
-                            self.find_snippets(self.clean_text(text),
-                                               doc_id=part.url,
-                                               page_id=page_url)
-
-                # Force a commit at lower than the nominal limit. This is
-                # intended to ensure that bundles of records from one
-                # publication are all committed at the same time.
-                if len(self.session) >= 1000:
-                    self.session.commit()
+            # The publication search returns the best metadata
+            pubs = [Reference(rec) for rec in records[start:]]
+
+            # Look up which documents are already in the database in one
+            # query per page instead of one per record unless pages are
+            # being re-mined
+            if not self.incremental:
+                existing |= self.existing_urls(session, [p.url for p in pubs])
+
+            # Decide which records need to be resolved before fetching so
+            # that the fetches can run ahead of the loop below
+            skip = []
+            for pub in pubs:
+                skip.append(pub.url in existing)
+                if not self.incremental:
+                    existing.add(pub.url)
+            fetched = self.fetch_records(
+                [r for r, s in zip(records[start:], skip) if not s]
+            )
+
+            # Process each publication based on its URL. Everything found
+            # in one publication is yielded as one item so that it is
+            # committed at the same time.
+            try:
+                for i, (pub, skipped) in enumerate(zip(pubs, skip), start):
+                    checkpoint = {"page": page, "index": i + 1}
+
+                    # Skip document if it's already in the database
+                    if skipped:
+                        logger.debug(f"{pub.url} already exists")
+                        yield SourceItem([], [], checkpoint)
+                        continue
+
+                    doc = next(fetched)
+                    if doc is None:
+                        # Save document anyway so it won't be re-checked
+                        yield SourceItem([pub], [], checkpoint)
+                        continue
+
+                    # Update the publication record based on the part/item
+                    if not pub.publication and pub.title != doc.title:
+                        pub.publication = doc.title
+                    if pub.url != doc.publication_url:
+                        pub.publication_url = doc.publication_url
+                    documents = [pub]
+
+                    # For items with no parts, use the item itself
+                    parts = doc.parts
+                    if not parts:
+                        parts = [doc]
+
+                    # Look for specimen numbers in each part
+                    pages = []
+                    for part in parts:
+                        if part.url != doc.url:
+                            documents.append(part)
+                        for page_num, text in part.content.items():
+                            if text:
+                                page_url = f"https://biodiversitylibrary.org/page/{page_num}"
+                                pages.append(TextPage(
+                                    self.clean_text(text), part.url, page_url, key=page_url
+                                ))
+
+                    yield SourceItem(documents, pages, checkpoint)
+            finally:
+                fetched.close()
 
             page += 1
-
-        # Perform a final commit
-        self.session.commit()
-
-        logger.info("Mining completed")
+            start = 0
@@ -1,14 +1,38 @@
 """Defines shared methods for mining catalog numbers from a generic corpus"""
+import csv
+import datetime as dt
 import hashlib
+import json
 import logging
+import multiprocessing
+import queue
 import re
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from functools import partial, wraps
 
 from nmnh_ms_tools.tools.specimen_numbers.parser import Parser
 
 from ..databases.citations import (
-    Session, DarwinCore, Document, Journal, Link, Snippet, Specimen
+    Session,
+    Checkpoint,
+    DarwinCore,
+    Document,
+    Journal,
+    Link,
+    MinedPage,
+    Page,
+    Snippet,
+    Specimen,
+    has_fts,
+)
+from .timing import Timer, TimedProxy
+from ..utils import (
+    PARSE_CACHE, SessionWrapper, parse_spec_nums, parser_key, parser_version
 )
-from ..utils import SessionWrapper
 
 
 
@@ -18,24 +42,681 @@ logger = logging.getLogger(__name__)
 
 
 
+# Forms of the USNM/NMNH codes that may not appear in Parser.codes
+PREFILTER_FORMS = [
+    r"U\.?\s*S\.?\s*N\.?\s*M",
+    r"N\.?\s*M\.?\s*N\.?\s*H",
+    r"Nat(?:ional|\.)?\s*Mus",
+]
+
+
+
+
+class SnippetExtractor:
+    """Finds snippets and catalog numbers in text without touching the database
+
+    Extractors hold only the parser and compiled patterns, so they can be
+    pickled and sent to worker processes.
+    """
+
+    def __init__(self, parser=None, prefilter=True):
+        self.parser = parser if parser is not None else Parser()
+        # Skip pages that do not mention any museum code
+        self.prefilter = prefilter
+        # Set by Miner.instrument to return parser timings from workers
+        self.timer = None
+        self.compile_patterns()
+
+
+    def compile_patterns(self):
+        """Compiles patterns, the cache key, and the version for the parser
+
+        Call again if the parser is replaced.
+        """
+        self._parser_key = parser_key(self.parser)
+        self.version = parser_version(self.parser)
+
+        codes = list(self.parser.codes)
+        self._candidate_pattern = r"\b({})\b".format("|".join(codes))
+        self._candidate_regex = re.compile(self._candidate_pattern)
+
+        # The prefilter is deliberately loose so it never rejects a page the
+        # parser would match. Codes that are plain words may be spaced out or
+        # abbreviated with periods.
+        forms = PREFILTER_FORMS[:]
+        for code in codes:
+            if code.isalnum():
+                code = r"\.?\s*".join(re.escape(c) for c in code)
+            forms.append(code)
+        self._prefilter_regex = re.compile("|".join(forms), flags=re.I)
+
+
+    def extract(self, text, **kwargs):
+        """Finds and parses snippets with catalog numbers in text
+
+        Returns a tuple of (matches, candidates), where matches is a list of
+        (verbatim, spec_nums, snippets) tuples and candidates is a list of
+        snippets that mention a museum code but were not parsed. Snippets
+        are returned as plain strings.
+        """
+        kwargs.setdefault("clean", True)
+
+        if self.prefilter and not self._prefilter_regex.search(text):
+            return [], []
+
+        spec_num_snippets = self.parser.snippets(text, **kwargs)
+
+        matches = []
+        for verbatim, snippets in spec_num_snippets.items():
+            spec_nums = parse_spec_nums(self.parser, verbatim, self._parser_key)
+            matches.append((verbatim, spec_nums, [s.text for s in snippets]))
+
+        # Replace verbatims with placeholders of equal length
+        text = self.mask_verbatims(text, spec_num_snippets)
+
+        # Find candidates missed by the parser
+        candidates = []
+        if self._candidate_regex.search(text):
+            candidate_snippets = self.parser.snippets(
+                text, self._candidate_pattern, num_chars=kwargs.get("num_chars", 64)
+            )
+            for snippets in candidate_snippets.values():
+                candidates.extend(s.text for s in snippets)
+
+        return matches, candidates
+
+
+    def mask_verbatims(self, text, verbatims):
+        """Replaces each verbatim in text with spaces of equal length
+
+        Finds every occurrence of every verbatim in one regex pass, then
+        takes the occurrences of each verbatim in order, skipping any that
+        overlap a span that has already been masked, and masks the spans in
+        a single pass. This gives the same result as calling str.replace for
+        each verbatim unless a verbatim can match the placeholder spaces
+        themselves, but runs in time linear in the length of the text.
+        """
+        verbatims = [v for v in verbatims if v]
+        if not verbatims:
+            return text
+
+        # Find occurrences of each verbatim, including overlapping ones. The
+        # lookahead returns the longest verbatim at each position, and any
+        # shorter verbatims starting there are prefixes of that one.
+        lookup = set(verbatims)
+        lengths = sorted({len(v) for v in verbatims})
+        occurrences = {}
+        pattern = "(?=({}))".format(_trie_pattern(verbatims))
+        for match in re.finditer(pattern, text):
+            longest = match.group(1)
+            for length in lengths:
+                if length > len(longest):
+                    break
+                if longest[:length] in lookup:
+                    occurrences.setdefault(longest[:length], []).append(match.start())
+
+        # Select non-overlapping spans in the order verbatims were given
+        masked = bytearray(len(text))
+        spans = []
+        for verbatim in verbatims:
+            length = len(verbatim)
+            cursor = 0
+            for start in occurrences.get(verbatim, []):
+                end = start + length
+                if start >= cursor and masked.find(1, start, end) < 0:
+                    masked[start:end] = b"\x01" * length
+                    spans.append((start, end))
+                    cursor = end
+
+        if not spans:
+            return text
+
+        spans.sort()
+        parts = []
+        last = 0
+        for start, end in spans:
+            parts.extend([text[last:start], " " * (end - start)])
+            last = end
+        parts.append(text[last:])
+        return "".join(parts)
+
+
+
+
+# Pages of text and the documents they belong to, as yielded by a source.
+# The checkpoint is the state needed to resume after the item is saved. The
+# key identifies a page whose text may change between runs, and mined holds
+# the state of the page from the last run when re-mining incrementally.
+TextPage = namedtuple(
+    "TextPage", ["text", "doc_id", "page_id", "key", "mined"], defaults=[None, None]
+)
+SourceItem = namedtuple(
+    "SourceItem", ["documents", "pages", "checkpoint"], defaults=[None]
+)
+
+# Marks the end of the items passed between two pipeline stages
+_DONE = object()
+
+
+
+
+@dataclass
+class StageStats:
+    """Counts items and time for one stage of a Pipeline
+
+    Attributes:
+        name (str): name of the stage
+        items (int): number of items the stage produced
+        seconds (float): total time the stage was running
+        waiting (float): time spent waiting on the previous or next stage
+    """
+    name: str
+    items: int = 0
+    seconds: float = 0.0
+    waiting: float = 0.0
+
+
+    @property
+    def busy(self):
+        """Gets the time the stage spent doing its own work"""
+        return max(self.seconds - self.waiting, 0)
+
+
+    def __str__(self):
+        rate = self.items / self.busy if self.busy else 0
+        return (f"{self.name}: {self.items:,} items, {self.busy:.1f}s busy,"
+                f" {self.waiting:.1f}s waiting ({rate:,.1f} items/s)")
+
+
+
+
+class Pipeline:
+    """Runs items from a source through generator stages into a sink
+
+    Each stage is a callable that takes an iterator of items and returns an
+    iterator of items. The source and each stage run on their own thread
+    and pass items through bounded queues, so memory use depends on the
+    queue size, not on the size of the corpus. The sink is called once per
+    item on the thread that calls run.
+
+    Args:
+        source (iterable): yields the items to process
+        stages (list): callables or (name, callable) tuples
+        sink (callable): called with each item from the last stage
+        queue_size (int): number of items each queue can hold
+
+    Attributes:
+        stats (dict): StageStats keyed by stage name
+    """
+
+    def __init__(self, source, stages, sink, queue_size=4):
+        self.source = source
+        self.stages = [self._name_stage(s) for s in stages]
+        self.sink = self._name_stage(sink)
+        self.queue_size = queue_size
+        self.stats = {}
+        self._errors = []
+        self._stop = threading.Event()
+
+
+    def run(self):
+        """Runs the pipeline until the source is exhausted"""
+        self.stats = {}
+        self._errors = []
+        self._stop.clear()
+
+        threads = []
+        inbox = None
+        for name, func in [("source", self._read_source)] + self.stages:
+            outbox = queue.Queue(maxsize=self.queue_size)
+            stats = self.stats[name] = StageStats(name)
+            thread = threading.Thread(
+                target=self._run_stage,
+                args=(func, inbox, outbox, stats),
+                name=f"pipeline-{name}",
+                daemon=True,
+            )
+            thread.start()
+            threads.append(thread)
+            inbox = outbox
+
+        name, func = self.sink
+        stats = self.stats[name] = StageStats(name)
+        start = time.perf_counter()
+        try:
+            for item in self._drain(inbox, stats):
+                func(item)
+                stats.items += 1
+        except Exception:
+            self._stop.set()
+            raise
+        finally:
+            stats.seconds += time.perf_counter() - start
+            for thread in threads:
+                thread.join()
+
+        if self._errors:
+            raise self._errors[0]
+
+
+    def log_stats(self):
+        """Logs the stats for each stage"""
+        for stats in self.stats.values():
+            logger.info(f"Pipeline stage {stats}")
+
+
+    def _read_source(self, _):
+        """Iterates the source"""
+        return iter(self.source)
+
+
+    def _run_stage(self, func, inbox, outbox, stats):
+        """Moves items from one queue to the next through a stage"""
+        start = time.perf_counter()
+        items = None
+        try:
+            items = iter(func(self._drain(inbox, stats) if inbox else None))
+            for item in items:
+                stats.items += 1
+                if not self._put(outbox, item, stats):
+                    break
+        except Exception as exc:
+            self._errors.append(exc)
+            self._stop.set()
+        finally:
+            if hasattr(items, "close"):
+                items.close()
+            stats.seconds += time.perf_counter() - start
+            self._put(outbox, _DONE, stats)
+
+
+    def _drain(self, inbox, stats):
+        """Yields items from a queue until the previous stage is done"""
+        while True:
+            start = time.perf_counter()
+            while True:
+                try:
+                    item = inbox.get(timeout=0.1)
+                    break
+                except queue.Empty:
+                    if self._stop.is_set():
+                        return
+            stats.waiting += time.perf_counter() - start
+            if item is _DONE:
+                return
+            yield item
+
+
+    def _put(self, outbox, item, stats):
+        """Puts an item on a queue, returning False if the pipeline stops"""
+        start = time.perf_counter()
+        try:
+            while not self._stop.is_set():
+                try:
+                    outbox.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        finally:
+            stats.waiting += time.perf_counter() - start
+
+
+    @staticmethod
+    def _name_stage(stage):
+        """Returns a (name, callable) tuple for a stage"""
+        if isinstance(stage, tuple):
+            return stage
+        return (getattr(stage, "__name__", repr(stage)), stage)
+
+
+
+
 class Miner:
-    """Tools for mining catalog numbers from a generic corpus"""
+    """Tools for mining catalog numbers from a generic corpus
+
+    Subclasses implement iter_source to yield SourceItems. The mine method
+    runs those items through the pipeline returned by build_pipeline, which
+    extracts snippets (extract_stage), builds ORM records (record_stage),
+    and adds them to the session (write_stage).
+
+    Sources that attach a checkpoint to their items can be resumed. The
+    checkpoint is written in the same commit as the records for the item,
+    and mine(..., resume=True) passes the last saved checkpoint back to
+    iter_source as the state keyword argument.
+
+    If incremental is True, each page is recorded with a hash of its text
+    and the parser version. Pages that have not changed since they were
+    last mined are skipped, and snippets and specimens that a changed page
+    no longer produces are deleted.
+    """
 
     def __init__(self):
         self.bot = None
         self.source = "Unknown"
-        self.parser = Parser()
-        self.session = SessionWrapper(Session, limit=10000)
+        self.extractor = SnippetExtractor()
+        self.session = SessionWrapper(
+            Session,
+            limit=10000,
+            bulk=True,
+            # Snippets, specimens, and pages are keyed to a hash of their
+            # content, so existing rows are left alone
+            on_conflict={
+                Document: "update",
+                MinedPage: "update",
+                Checkpoint: "update",
+            },
+            cache_size=100000,
+        )
         self.session.order = [
-            Journal, Document, Specimen, Snippet, Link, DarwinCore
+            Journal, Document, Page, Snippet, Specimen, MinedPage, Link,
+            DarwinCore, Checkpoint,
         ]
+        # Identifies the checkpoint for the current run
+        self.checkpoint_key = None
+        # Skip pages mined with the same text and parser version
+        self.incremental = False
+        # Store page text once and save snippets as offsets into the page.
+        # Not supported when the full-text index is enabled.
+        self.store_pages = False
+        self.page_codec = "zlib"
+        # Extract snippets in a process pool if workers is greater than 1.
+        # Workers are spawned, so scripts that use them need a main guard.
+        self.workers = 1
+        self.chunk_size = 16
+        self._executor = None
+        # Keyword arguments passed to the parser when mining
+        self.parser_kwargs = {}
+        # Number of items each pipeline queue can hold
+        self.queue_size = 4
+        self.pipeline_stats = {}
+        # Set by instrument to time and count each part of a run
+        self.timer = None
+
+
+    @property
+    def parser(self):
+        """Gets the specimen number parser used by the extractor"""
+        return self.extractor.parser
+
+
+    @parser.setter
+    def parser(self, parser):
+        self.extractor.parser = parser
+        self.extractor.compile_patterns()
+        self.close_pool()
+
+
+    @property
+    def prefilter(self):
+        """Gets whether pages without a museum code are skipped"""
+        return self.extractor.prefilter
+
+
+    @prefilter.setter
+    def prefilter(self, prefilter):
+        self.extractor.prefilter = prefilter
+        self.close_pool()
+
+
+    def mine(self, *args, resume=False, **kwargs):
+        """Mines specimen numbers from the specified corpus
+
+        Args:
+            args: positional arguments passed to iter_source
+            resume (bool): whether to resume from the last checkpoint saved
+                for a run with the same arguments
+            kwargs: keyword arguments passed to iter_source
+        """
+        if self.store_pages and has_fts(self.session.bind):
+            raise ValueError("Cannot store pages in a database with a"
+                             " full-text index. Disable store_pages or"
+                             " drop the index using disable_fts.")
+        self.checkpoint_key = self.make_checkpoint_key(*args, **kwargs)
+        if resume:
+            state = self.load_checkpoint()
+            if state is not None:
+                logger.info(f"Resuming {self.checkpoint_key} from {state}")
+                kwargs["state"] = state
+        source = self.iter_source(*args, **kwargs)
+        self.run_pipeline(source, **self.parser_kwargs)
+        self.session.flush()
+        logger.info("Mining completed")
+        if self.timer is not None:
+            self.timer.report()
 
 
-    def mine(self, terms, maxpage=None, **kwargs):
-        """Mines specimen numbers from the specified corpus"""
+    def instrument(self, interval=60):
+        """Times and counts the work done while mining
+
+        Records time spent fetching from the bot, cleaning text, finding
+        snippets, parsing catalog numbers, hashing, and committing, and
+        counts pages, snippets, and specimen numbers. The instrumented
+        methods are wrapped here, so miners that are never instrumented run
+        without any overhead. Call after the parser has been configured.
+
+        Args:
+            interval (float): seconds between summary log lines
+
+        Returns:
+            the Timer used to record the stats
+        """
+        if self.timer is not None:
+            return self.timer
+        timer = self.timer = Timer(interval)
+
+        if self.bot is not None:
+            self.bot = TimedProxy(self.bot, timer, "fetch")
+        self.clean_text = timer.wrap("clean_text", self.clean_text)
+        self.hash_id = timer.wrap("hash", self.hash_id)
+        self.session._write = timer.wrap("commit", self.session._write)
+
+        # The extractor is sent to workers with the timer, so parser timings
+        # are returned with the results from each chunk
+        self.extractor.parser = TimedProxy(self.extractor.parser, timer, {
+            "snippets": "parser.snippets",
+            "parse": "parser.parse",
+        })
+        self.extractor.timer = timer
+        self.close_pool()
+
+        build_records = self.build_records
+
+        @wraps(build_records)
+        def counted(*args, **kwargs):
+            records = build_records(*args, **kwargs)
+            snippets = sum(isinstance(r, Snippet) for r in records)
+            specimens = sum(isinstance(r, Specimen) for r in records)
+            timer.count("pages")
+            timer.count("snippets", snippets)
+            timer.count("specimen numbers", specimens)
+            return records
+
+        self.build_records = counted
+        return timer
+
+
+    def iter_source(self, *args, state=None, **kwargs):
+        """Yields SourceItems from the specified corpus
+
+        Args:
+            args: positional arguments passed to mine
+            state (dict): checkpoint to resume from, if any
+            kwargs: keyword arguments passed to mine
+        """
         raise NotImplementedError
 
 
+    def make_checkpoint_key(self, *args, **kwargs):
+        """Builds a key identifying a run from the arguments passed to mine"""
+        params = json.dumps([args, kwargs], sort_keys=True, default=str)
+        return f"{self.source}:{_md5(params)}"
+
+
+    def load_checkpoint(self, key=None):
+        """Loads the last checkpoint saved for a run
+
+        Returns:
+            checkpoint state as a dict or None if no checkpoint exists
+        """
+        if key is None:
+            key = self.checkpoint_key
+        session = Session()
+        try:
+            rec = session.query(Checkpoint).filter_by(key=key).first()
+            return json.loads(rec.state) if rec else None
+        finally:
+            session.close()
+
+
+    def save_checkpoint(self, state, key=None):
+        """Saves a checkpoint and commits it with any pending records"""
+        self.session.add(self.build_checkpoint(state, key))
+        self.session.flush()
+
+
+    def build_pipeline(self, source, **kwargs):
+        """Builds the pipeline used to mine items from source
+
+        Override to replace, add, or remove stages.
+        """
+        stages = [
+            ("extract", partial(self.extract_stage, **kwargs)),
+            ("records", self.record_stage),
+        ]
+        if self.incremental:
+            stages.insert(0, ("filter", self.filter_stage))
+        return Pipeline(
+            source, stages, ("write", self.write_stage), queue_size=self.queue_size
+        )
+
+
+    def run_pipeline(self, source, **kwargs):
+        """Mines SourceItems from source and logs the stats for each stage"""
+        pipeline = self.build_pipeline(source, **kwargs)
+        try:
+            pipeline.run()
+        finally:
+            self.pipeline_stats = pipeline.stats
+            pipeline.log_stats()
+
+
+    def filter_stage(self, items):
+        """Removes pages mined with the same text and parser version
+
+        Pages that are kept are annotated with the snippets and specimens
+        they produced when they were last mined.
+        """
+        session = Session()
+        skipped = 0
+        try:
+            for item in items:
+                pages = []
+                ids = [self.mined_page_id(p) for p in item.pages]
+                mined = {}
+                for i in range(0, len(ids), 500):
+                    query = session.query(MinedPage).filter(
+                        MinedPage.id.in_(ids[i:i + 500])
+                    )
+                    mined.update({r.id: r for r in query})
+                for page, mined_id in zip(item.pages, ids):
+                    text_hash = _md5(page.text)
+                    rec = mined.get(mined_id)
+                    if (
+                        rec is not None
+                        and rec.text_hash == text_hash
+                        and rec.parser_version == self.extractor.version
+                    ):
+                        skipped += 1
+                        continue
+                    pages.append(page._replace(mined={
+                        "id": mined_id,
+                        "text_hash": text_hash,
+                        "snippet_ids": json.loads(rec.snippet_ids) if rec else [],
+                        "specimen_ids": json.loads(rec.specimen_ids) if rec else [],
+                    }))
+                yield item._replace(pages=pages)
+        finally:
+            session.close()
+            logger.info(f"Skipped {skipped:,} unchanged pages")
+
+
+    def extract_stage(self, items, **kwargs):
+        """Yields (item, results) for each SourceItem
+
+        Results are the output of SnippetExtractor.extract for each page in
+        the item, in order. Pages are sent to the extractor in chunks of
+        chunk_size regardless of how they are split into items, and each
+        item is yielded once all of its pages have been extracted.
+        """
+        # Items read from the source as (item, results) tuples, in order
+        waiting = deque()
+
+        def pages():
+            for item in items:
+                results = []
+                waiting.append((item, results))
+                for page in item.pages:
+                    yield results, page
+
+        chunks = (tuple(zip(*c)) for c in _chunked(pages(), self.chunk_size))
+        for targets, _, results in self._extract_chunks(chunks, kwargs):
+            for target, result in zip(targets, results):
+                target.append(result)
+            while waiting and len(waiting[0][1]) == len(waiting[0][0].pages):
+                yield waiting.popleft()
+        while waiting:
+            yield waiting.popleft()
+
+
+    def record_stage(self, items):
+        """Yields (records, deletes) for each (item, results) tuple
+
+        Records is a list of ORM records. Deletes maps models to the primary
+        keys of rows that re-mined pages no longer produce.
+        """
+        for item, results in items:
+            records = []
+            deletes = {}
+            for document in item.documents:
+                records.extend(self.build_document(document))
+            for page, extracted in zip(item.pages, results):
+                page_records = self.build_records(
+                    extracted, page.text, page.doc_id, page.page_id
+                )
+                records.extend(page_records)
+                if page.mined is not None:
+                    rec = self.build_mined_page(page, page_records)
+                    records.append(rec)
+                    for model, attr in (
+                        (Snippet, "snippet_ids"), (Specimen, "specimen_ids")
+                    ):
+                        stale = set(page.mined[attr]) - set(json.loads(getattr(rec, attr)))
+                        deletes.setdefault(model, set()).update(stale)
+            if item.checkpoint is not None:
+                records.append(self.build_checkpoint(item.checkpoint))
+            yield records, deletes
+
+
+    def write_stage(self, batch):
+        """Writes records and deletes from one SourceItem in the same commit"""
+        records, deletes = batch
+        with self.session.group():
+            for model, keys in deletes.items():
+                self.session.delete_all(model, keys)
+            self.session.add_all(records)
+
+
+    def mined_page_id(self, page):
+        """Builds the key used to record that a page has been mined
+
+        Pages without a key are identified by their text, so a change to
+        the text is treated as a new page.
+        """
+        key = page.key if page.key else _md5(page.text)
+        return _md5("\x00".join([page.doc_id, page.page_id or "", key]))
+
+
     def clean_text(self, text):
         """Cleans up whitespace in text"""
         return re.sub(r"\s+", " ", text)
@@ -43,33 +724,168 @@ class Miner:
 
     def find_snippets(self, text, doc_id, page_id, **kwargs):
         """Finds, parses, and saves snippets with catalog numbers"""
+        extracted = self.extractor.extract(text, **kwargs)
+        self.save_snippets(extracted, text, doc_id, page_id)
 
-        kwargs.setdefault("clean", True)
 
-        spec_num_snippets = self.parser.snippets(text, **kwargs)
-        for verbatim, snippets in spec_num_snippets.items():
-            spec_nums = self.parser.parse(verbatim)
+    def find_snippets_many(self, pages, **kwargs):
+        """Finds, parses, and saves snippets for many pages
+
+        Args:
+            pages (iterable): (text, doc_id, page_id) tuples
+            kwargs: keyword arguments passed to the parser
+
+        If workers is greater than 1, pages are sent to a process pool in
+        chunks. Results are saved by this process in the order the pages
+        were given, and only a few chunks are in flight at any time, so
+        pages can be a generator.
+        """
+        chunks = ((None, c) for c in _chunked(pages, self.chunk_size))
+        for _, chunk, results in self._extract_chunks(chunks, kwargs):
+            for (text, doc_id, page_id), extracted in zip(chunk, results):
+                self.save_snippets(extracted, text, doc_id, page_id)
+
+
+    def save_snippets(self, extracted, text, doc_id, page_id):
+        """Saves snippets and specimens returned by SnippetExtractor.extract"""
+        self.session.add_all(self.build_records(extracted, text, doc_id, page_id))
+
+
+    def build_records(self, extracted, text, doc_id, page_id):
+        """Builds records for snippets returned by SnippetExtractor.extract"""
+        matches, candidates = extracted
+
+        records = []
+        page = None
+        if self.store_pages and matches:
+            rec = self.build_page(text)
+            records.append(rec)
+            page = (rec.hash, text)
+
+        for verbatim, spec_nums, snippets in matches:
             for snippet in snippets:
-                snippet_id = self.save_snippet(snippet, doc_id, page_id)
+                rec = self.build_snippet(snippet, doc_id, page_id, page)
+                records.append(rec)
                 for spec_num in spec_nums:
-                    self.save_specimen(spec_num, verbatim, snippet_id)
+                    records.append(self.build_specimen(spec_num, verbatim, rec.id))
 
-            # Replace verbatim with placeholder of equal length
-            text = text.replace(verbatim, " " * len(verbatim))
+        for snippet in candidates:
+            records.append(self.build_snippet(snippet, doc_id, page_id))
 
-        # Find candidates missed by the parser
-        pattern = r"\b({})\b".format("|".join(self.parser.codes))
-        candidate_snippets = self.parser.snippets(
-            text, pattern, num_chars=kwargs.get("num_chars", 64)
-        )
-        for verbatim, snippets in candidate_snippets.items():
-            for snippet in snippets:
-                self.save_snippet(snippet, doc_id, page_id)
+        return records
+
+
+    def mask_verbatims(self, text, verbatims):
+        """Replaces each verbatim in text with spaces of equal length"""
+        return self.extractor.mask_verbatims(text, verbatims)
+
+
+    def close_pool(self):
+        """Shuts down the worker pool if one is running"""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+    def close(self):
+        """Shuts down the worker pool and writes any pending records"""
+        self.close_pool()
+        self.session.close()
+
+
+    def _get_executor(self):
+        """Starts the worker pool if it is not already running
+
+        Workers are spawned rather than forked because the pipeline and
+        the session writer run threads, and forking a process with running
+        threads can copy locks that are held and never released.
+        """
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(self.extractor,),
+            )
+        return self._executor
+
+
+    def _extract_chunks(self, chunks, kwargs):
+        """Yields (key, pages, results) for (key, pages) tuples in order
+
+        Uses the worker pool if workers is greater than 1, keeping only a
+        few chunks in flight at a time.
+        """
+        if self.workers <= 1:
+            for key, pages in chunks:
+                results = [self.extractor.extract(p[0], **kwargs) for p in pages]
+                yield key, pages, results
+            return
+
+        executor = self._get_executor()
+        pending = deque()
+        for key, pages in chunks:
+            texts = [p[0] for p in pages]
+            future = executor.submit(_extract_many, texts, kwargs)
+            pending.append((key, pages, future))
+            if len(pending) > 2 * self.workers:
+                key, pages, future = pending.popleft()
+                yield key, pages, self._get_results(future)
+        while pending:
+            key, pages, future = pending.popleft()
+            yield key, pages, self._get_results(future)
+
+
+    def _get_results(self, future):
+        """Gets results from a worker, recording any timings it returns"""
+        results, timings, cache_counts = future.result()
+        if timings:
+            self.timer.merge(timings)
+        PARSE_CACHE.add_counts(*cache_counts)
+        return results
 
 
     def save_document(self, document):
         """Saves document to citations database"""
-        self.session.add(Document(
+        self.session.add_all(self.build_document(document))
+        return document.url
+
+
+    def save_journal(self, title):
+        """Saves journal to citations database"""
+        self.session.add(self.build_journal(title))
+        return title.title()
+
+
+    def save_page(self, text):
+        """Saves compressed page text to citations database"""
+        rec = self.build_page(text)
+        self.session.add(rec)
+        return rec.hash
+
+
+    def save_snippet(self, snippet, doc_id, page_id="", page=None):
+        """Saves snippet to citations database"""
+        rec = self.build_snippet(snippet, doc_id, page_id, page)
+        self.session.add(rec)
+        return rec.id
+
+
+    def save_specimen(self, spec_num, verbatim, snippet_id):
+        """Saves specimen number to citations database"""
+        rec = self.build_specimen(spec_num, verbatim, snippet_id)
+        self.session.add(rec)
+        return rec.id
+
+
+    def hash_id(self, *parts):
+        """Builds an id by hashing the concatenated parts"""
+        return _md5("".join(parts))
+
+
+    def build_document(self, document):
+        """Builds the document and journal records for a reference"""
+        records = [Document(
             url=document.url,
             publication_url=document.publication_url,
             kind=document.kind,
@@ -81,36 +897,238 @@ class Miner:
             number=document.number,
             pages=document.pages,
             doi=document.doi,
-        ))
+        )]
         if document.publication:
-            self.save_journal(document.publication)
-        return document.url
+            records.append(self.build_journal(document.publication))
+        return records
 
 
-    def save_journal(self, title):
-        """Saves journal to citations database"""
-        self.session.add(Journal(title=title.title()))
-        return title.title()
+    def build_journal(self, title):
+        """Builds a journal record"""
+        return Journal(title=title.title())
+
+
+    def build_page(self, text):
+        """Builds a compressed page record"""
+        return Page(
+            hash=self.hash_id(text),
+            codec=self.page_codec,
+            content=Page.compress(text, self.page_codec),
+        )
 
 
-    def save_snippet(self, snippet, doc_id, page_id=""):
-        snippet_id = hashlib.md5((doc_id + page_id + snippet.text).encode("utf-8")).hexdigest()
-        self.session.add(Snippet(
+    def build_snippet(self, snippet, doc_id, page_id="", page=None):
+        """Builds a snippet record
+
+        If page is a (hash, text) tuple and the snippet occurs verbatim in
+        that text, the snippet is saved as offsets into the page. The snippet
+        may be a string or an object with a text attribute.
+        """
+        snippet = getattr(snippet, "text", snippet)
+        snippet_id = self.hash_id(doc_id, page_id, snippet)
+        rec = Snippet(
             id=snippet_id,
             doc_url=doc_id,
             page_id=page_id,
-            snippet=snippet.text,
-        ))
-        return snippet_id
+            snippet=snippet,
+        )
+        if page is not None:
+            page_hash, text = page
+            start = text.find(snippet)
+            if start >= 0:
+                rec.snippet = None
+                rec.page_hash = page_hash
+                rec.start_offset = start
+                rec.end_offset = start + len(snippet)
+        return rec
 
 
-    def save_specimen(self, spec_num, verbatim, snippet_id):
-        """Saves specimen number to citations database"""
-        specimen_id = hashlib.md5((snippet_id + spec_num).encode("utf-8")).hexdigest()
-        self.session.add(Specimen(
+    def build_checkpoint(self, state, key=None):
+        """Builds a checkpoint record"""
+        if key is None:
+            key = self.checkpoint_key
+        if key is None:
+            raise ValueError("Checkpoint key not set")
+        return Checkpoint(
+            key=key,
+            source=self.source,
+            state=json.dumps(state, sort_keys=True),
+            updated=dt.datetime.now().isoformat(),
+        )
+
+
+    def build_mined_page(self, page, records):
+        """Builds a record of the snippets and specimens mined from a page"""
+        snippet_ids = [r.id for r in records if isinstance(r, Snippet)]
+        specimen_ids = [r.id for r in records if isinstance(r, Specimen)]
+        return MinedPage(
+            id=page.mined["id"],
+            doc_url=page.doc_id,
+            page_id=page.page_id,
+            text_hash=page.mined["text_hash"],
+            parser_version=self.extractor.version,
+            snippet_ids=json.dumps(sorted(set(snippet_ids))),
+            specimen_ids=json.dumps(sorted(set(specimen_ids))),
+            updated=dt.datetime.now().isoformat(),
+        )
+
+
+    def build_specimen(self, spec_num, verbatim, snippet_id):
+        """Builds a specimen record"""
+        specimen_id = self.hash_id(snippet_id, spec_num)
+        return Specimen(
             id=specimen_id,
             snippet_id=snippet_id,
             spec_num=spec_num,
             verbatim =verbatim,
-        ))
-        return specimen_id
+        )
+
+
+
+
+# Extractor used by worker processes, set once per process by _init_worker
+_EXTRACTOR = None
+
+
+
+
+def _init_worker(extractor):
+    """Stores the extractor in a worker process"""
+    global _EXTRACTOR
+    _EXTRACTOR = extractor
+    # Discard timings copied from the parent so they are not counted twice
+    if extractor.timer is not None:
+        extractor.timer.pop()
+
+
+
+
+def _extract_many(texts, kwargs):
+    """Extracts snippets from a list of texts in a worker process
+
+    Returns:
+        Tuple of (results, timings, cache_counts), where timings is None
+        unless the extractor is instrumented and cache_counts is the
+        number of (hits, misses) on the worker's parse cache
+    """
+    hits, misses = PARSE_CACHE.hits, PARSE_CACHE.misses
+    results = [_EXTRACTOR.extract(text, **kwargs) for text in texts]
+    timings = _EXTRACTOR.timer.pop() if _EXTRACTOR.timer is not None else None
+    cache_counts = (PARSE_CACHE.hits - hits, PARSE_CACHE.misses - misses)
+    return results, timings, cache_counts
+
+
+
+
+def read_csv(path, offset=0, encoding="utf-8-sig", clean=None, **kwargs):
+    """Yields (rowdict, offset) for each row in a CSV file
+
+    Args:
+        path (str): path to the CSV file
+        offset (int): byte offset to start reading from. Must be an offset
+            returned by an earlier call.
+        encoding (str): encoding of the file
+        clean (callable): if given, applied to each line before parsing
+        kwargs: keyword arguments passed to csv.reader
+
+    The offset yielded with each row is the position just after that row,
+    so it can be saved in a checkpoint and passed back to resume from the
+    next row.
+    """
+    with open(path, "rb") as f:
+        lines = _LineReader(f, encoding, clean)
+        keys = next(csv.reader(lines, **kwargs))
+        if offset:
+            lines.seek(offset)
+        for row in csv.reader(lines, **kwargs):
+            yield dict(zip(keys, row)), lines.offset
+
+
+
+
+class _LineReader:
+    """Iterates the decoded lines of a binary file, tracking the offset
+
+    csv.reader reads one line at a time and never reads ahead, so after it
+    returns a row, the offset is the end of that row even if a quoted value
+    spans several lines.
+    """
+
+    def __init__(self, f, encoding="utf-8-sig", clean=None):
+        self._f = f
+        self._encoding = encoding
+        self._clean = clean
+        self.offset = f.tell()
+
+
+    def __iter__(self):
+        return self
+
+
+    def __next__(self):
+        line = self._f.readline()
+        if not line:
+            raise StopIteration
+        # The byte order mark, if any, only occurs at the start of the file
+        encoding = self._encoding
+        if self.offset and encoding == "utf-8-sig":
+            encoding = "utf-8"
+        self.offset += len(line)
+        line = line.decode(encoding)
+        if self._clean is not None:
+            line = self._clean(line)
+        return line
+
+
+    def seek(self, offset):
+        """Moves to the given byte offset"""
+        self._f.seek(offset)
+        self.offset = offset
+
+
+
+
+def _md5(text):
+    """Returns the hex MD5 digest of a string"""
+    return hashlib.md5(text.encode("utf-8")).hexdigest()
+
+
+
+
+def _chunked(items, size):
+    """Yields lists of up to size items"""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+
+
+def _trie_pattern(strings):
+    """Builds a regex matching any of the strings, sharing common prefixes
+
+    Optional suffixes are greedy, so the pattern matches the longest string
+    that occurs at a given position.
+    """
+    trie = {}
+    for val in strings:
+        node = trie
+        for char in val:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def build(node):
+        alts = [re.escape(c) + build(n) for c, n in sorted(node.items()) if c]
+        if not alts:
+            return ""
+        pattern = alts[0] if len(alts) == 1 else "(?:{})".format("|".join(alts))
+        if "" in node:
+            pattern = "(?:{})?".format(pattern)
+        return pattern
+
+    return build(trie)
@@ -3,13 +3,14 @@ import csv
 import datetime as dt
 import json
 import logging
+import os
 import re
 import sys
 
 from nmnh_ms_tools.bots import GeoDeepDiveBot
 from nmnh_ms_tools.records import Reference
 
-from .core import Miner
+from .core import Miner, SourceItem, TextPage, read_csv
 
 
 
@@ -35,10 +36,17 @@ class GeoDeepDiveMiner(Miner):
         super().__init__()
         self.bot = GeoDeepDiveBot()
         self.source = "xDD"
+        self.parser_kwargs = {"num_chars": 10000}
 
 
-    def download(self, terms, **kwargs):
-        """Downloads snippets from the xDD API"""
+    def download(self, terms, resume=False, **kwargs):
+        """Downloads snippets from the xDD API
+
+        A checkpoint is saved after each batch of rows is written. If resume
+        is True, the last download with the same terms and parameters picks
+        up from its checkpoint. The xDD API expires scroll IDs, so a download
+        can only be resumed for a limited time after it stops.
+        """
         keys = None
 
         params = {
@@ -49,75 +57,113 @@ class GeoDeepDiveMiner(Miner):
         }
         params.update(kwargs)
 
-        response = self.bot.get_snippets(terms, **params)
-
-        # Initialize CSV file based on initial response
-        timestamp = dt.datetime.now().strftime("%Y%m%dT%H%M%S")
-        try:
-            path = f"xdd_{timestamp}_{response.json['success']['scrollId']}.csv"
-        except KeyError:
-            path = f"xdd_{timestamp}.csv"
-
         keys = ["_gddid", "doi", "highlight"]
+        key = self.make_checkpoint_key("download", terms, **params)
+
+        state = self.load_checkpoint(key) if resume else None
+        if state:
+            path = state["path"]
+            count = state["rows"]
+            offset = state["offset"]
+            if not state["scroll_id"]:
+                logger.info(f"Download to {path} already complete")
+                return
+
+            # Discard any rows written after the checkpoint
+            with open(path, "r+b") as f:
+                f.truncate(offset)
+            logger.info(f"Resuming download to {path} after {count:,} rows")
+
+            response = self.bot.get_snippets(scroll_id=state["scroll_id"])
+
+        else:
+            response = self.bot.get_snippets(terms, **params)
+
+            # Initialize CSV file based on initial response
+            timestamp = dt.datetime.now().strftime("%Y%m%dT%H%M%S")
+            try:
+                path = f"xdd_{timestamp}_{response.json['success']['scrollId']}.csv"
+            except KeyError:
+                path = f"xdd_{timestamp}.csv"
+
+            with open(path, "w", encoding="utf-8-sig", newline="") as f:
+                writer = csv.writer(f, dialect="excel")
+                writer.writerow(keys)
 
-        with open(path, "w", encoding="utf-8-sig", newline="") as f:
-            writer = csv.writer(f, dialect="excel")
-            writer.writerow(keys)
+            count = 0
+            offset = os.path.getsize(path)
 
         rows = []
-        count = 0
         while True:
 
             rows.extend(response)
+            scroll_id = response.json.get("success", {}).get("scrollId")
 
             # Write rows in batches of 1000
             if len(rows) >= 1000:
-                with open(path, "a", encoding="utf-8-sig", newline="") as f:
-                    writer = csv.writer(f, dialect="excel")
-                    for row in rows:
-                        row["highlight"] = self.clean_highlight(row["highlight"])
-                        writer.writerow([row.get(k, "") for k in keys])
+                offset = self.write_rows(path, rows, keys)
                 count += len(rows)
                 print(f"{count:,} rows written to CSV!")
 
                 rows = []
 
+                # Everything up to the next scroll is now in the file
+                self.save_checkpoint({
+                    "path": path,
+                    "scroll_id": scroll_id,
+                    "rows": count,
+                    "offset": offset,
+                }, key)
+
 
             # Scroll to next page if exists
-            scroll_id = response.json.get("success", {}).get("scrollId")
             if scroll_id:
                 response = self.bot.get_snippets(scroll_id=scroll_id)
             else:
                 break
 
         if rows:
-            with open(path, "a", encoding="utf-8-sig", newline="") as f:
-                writer = csv.writer(f, dialect="excel")
-                for row in rows:
-                    row["highlight"] = self.clean_highlight(row["highlight"])
-                    writer.writerow([row.get(k, "") for k in keys])
+            offset = self.write_rows(path, rows, keys)
+            count += len(rows)
+
+        self.save_checkpoint({
+            "path": path, "scroll_id": None, "rows": count, "offset": offset
+        }, key)
 
 
-    def mine(self, path):
-        """Mines specimen numbers downloaded from the xDD corpus"""
-        with open(path, "r", encoding="utf-8-sig", newline="") as f:
-            rows = csv.reader(f, dialect="excel")
-            keys = next(rows)
+    def write_rows(self, path, rows, keys):
+        """Appends rows to a CSV file and returns the new size of the file"""
+        with open(path, "a", encoding="utf-8-sig", newline="") as f:
+            writer = csv.writer(f, dialect="excel")
             for row in rows:
-                rowdict = dict(zip(keys, row))
-
-                if rowdict["doi"]:
-                    doc = Reference(rowdict["doi"])
-                else:
-                    response = self.bot.get_article(rowdict["_gddid"])
-                    doc = Reference(response.json["success"]["data"][0])
-                self.save_document(doc)
-                for text in json.loads(rowdict["highlight"]):
-                    self.find_snippets(re.sub(r"</?em.*?>", "", text),
-                                       doc_id=doc.url,
-                                       page_id="",
-                                       num_chars=10000)
-        self.session.commit()
+                row["highlight"] = self.clean_highlight(row["highlight"])
+                writer.writerow([row.get(k, "") for k in keys])
+        return os.path.getsize(path)
+
+
+    def iter_source(self, path, state=None):
+        """Yields highlights downloaded from the xDD corpus
+
+        The checkpoint for each item is the byte offset of the next row in
+        the CSV file.
+        """
+        offset = state["offset"] if state else 0
+        for rowdict, offset in read_csv(path, offset, dialect="excel"):
+
+            if rowdict["doi"]:
+                doc = Reference(rowdict["doi"])
+            else:
+                response = self.bot.get_article(rowdict["_gddid"])
+                doc = Reference(response.json["success"]["data"][0])
+
+            # Highlights have no page IDs, so key them by position. Keying
+            # them by text would leave the old rows behind if a highlight
+            # changes between downloads.
+            pages = []
+            for i, text in enumerate(json.loads(rowdict["highlight"])):
+                text = re.sub(r"</?em.*?>", "", text)
+                pages.append(TextPage(text, doc.url, "", key=f"{doc.url}#{i}"))
+            yield SourceItem([doc], pages, {"offset": offset})
 
 
     def clean_highlight(self, highlight):
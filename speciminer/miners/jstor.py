@@ -1,12 +1,12 @@
 """Defines functions used to mine a JSTOR/Portico export"""
 import csv
 import glob
+import hashlib
 import os
 
 from nmnh_ms_tools.records import Reference
 
-from .core import Miner
-from ..databases.citations import Document
+from .core import Miner, SourceItem, TextPage, read_csv
 
 
 
@@ -16,48 +16,66 @@ class JSTORMiner(Miner):
 
     def __init__(self, path):
         super().__init__()
+        self.source = "JSTOR"
         self.doc_path = glob.glob(os.path.join(path, "*documents.csv"))[0]
         self.sent_path = glob.glob(os.path.join(path, "*sentences.csv"))[0]
+        self.parser_kwargs = {"num_chars": 10000}
 
 
-    def mine(self):
-        """Mines specimen numbers downloaded from a JSTOR/Portico export"""
+    def iter_source(self, state=None):
+        """Yields sentences downloaded from a JSTOR/Portico export
+
+        The checkpoint for each item is the byte offset of the next row in
+        the sentences file.
+        """
         docs = self.read_docs()
 
-        # Find snippets
-        with open(self.sent_path, "r", encoding="utf-8-sig", newline="") as f:
+        # Get rid of nulls in the JSTOR file
+        rows = read_csv(
+            self.sent_path,
+            offset=state["offset"] if state else 0,
+            clean=lambda l: l.replace("\x00", "[NUL]"),
+        )
+
+        # Skip repeated text/doc/page combinations. Only a digest of each
+        # combination is kept so memory stays small.
+        seen = set()
+        documents = []
+        pages = []
+        offset = None
+        for rowdict, offset in rows:
+
+            # Read and parse document
+            doc = docs[rowdict["id"]]
+            if not isinstance(doc, Reference):
+                docs[rowdict["id"]] = Reference(doc, False)
+                doc = docs[rowdict["id"]]
+                documents.append(doc)
 
-            # Get rid of nulls in the JSTOR file
-            rows = csv.reader([l.replace("\x00", "[NUL]") for l in f])
-            keys = next(rows)
+            page_id = ""
+            if rowdict["page_seq"]:
+                page_id = f'{doc.url}#{rowdict["page_seq"]}'
 
-            # Find unique text/doc/page combinations
-            unique = {}
-            for row in rows:
-                rowdict = dict(zip(keys, row))
+            key = "\x00".join([rowdict["text"], doc.url, page_id])
+            digest = hashlib.md5(key.encode("utf-8")).digest()
+            if digest in seen:
+                continue
+            seen.add(digest)
+            pages.append(TextPage(rowdict["text"], doc.url, page_id))
 
-                # Read and parse document
-                doc = docs[rowdict["id"]]
-                if not isinstance(doc, Reference):
-                    docs[rowdict["id"]] = Reference(doc, False)
-                    doc = docs[rowdict["id"]]
-                    self.save_document(doc)
-                doc_url = doc.url
-
-                page_id = ""
-                if rowdict["page_seq"]:
-                    page_id = f'{doc_url}#{rowdict["page_seq"]}'
-
-                unique[(rowdict["text"], doc.url, page_id)] = 1
-
-            # Search for catalog numbers in each unique snippet
-            for text, doc_url, page_id in unique:
-                self.find_snippets(text,
-                                   doc_id=doc_url,
-                                   page_id=page_id,
-                                   num_chars=10000)
-
-        self.session.commit()
+            # Group sentences so each item is worth sending to a worker
+            if len(pages) >= self.chunk_size:
+                yield SourceItem(documents, pages, {"offset": offset})
+                documents = []
+                pages = []
+
+        if offset is not None:
+            yield SourceItem(documents, pages, {"offset": offset})
+
+
+    def make_checkpoint_key(self, *args, **kwargs):
+        """Builds a key identifying a run on this export"""
+        return super().make_checkpoint_key(self.sent_path, *args, **kwargs)
 
 
     def read_docs(self):
@@ -0,0 +1,157 @@
+"""Defines optional timers and counters for profiling mining runs"""
+import logging
+import threading
+import time
+from functools import wraps
+
+
+
+
+logger = logging.getLogger(__name__)
+
+
+
+
+class Timer:
+    """Accumulates calls, time, and counts for named stages
+
+    Args:
+        interval (float): if given, logs a summary at most once per this
+            many seconds
+
+    Attributes:
+        calls (dict): number of timed calls keyed by stage
+        seconds (dict): time spent in timed calls keyed by stage
+        counts (dict): totals for counters such as pages or snippets
+    """
+
+    def __init__(self, interval=None):
+        self.interval = interval
+        self.calls = {}
+        self.seconds = {}
+        self.counts = {}
+        self.started = time.perf_counter()
+        self._last_logged = self.started
+        self._lock = threading.Lock()
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+    def add(self, stage, secs, calls=1):
+        """Adds time spent in a stage"""
+        with self._lock:
+            self.calls[stage] = self.calls.get(stage, 0) + calls
+            self.seconds[stage] = self.seconds.get(stage, 0) + secs
+
+
+    def count(self, counter, num=1):
+        """Adds to a counter, logging a summary if the interval has passed"""
+        with self._lock:
+            self.counts[counter] = self.counts.get(counter, 0) + num
+        if self.interval:
+            now = time.perf_counter()
+            if now - self._last_logged >= self.interval:
+                self._last_logged = now
+                self.log()
+
+
+    def wrap(self, stage, func):
+        """Wraps a callable so that each call is timed"""
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - start)
+        return wrapped
+
+
+    def pop(self):
+        """Returns the calls and time recorded so far and resets them"""
+        with self._lock:
+            timings = {k: (self.calls[k], self.seconds[k]) for k in self.calls}
+            self.calls = {}
+            self.seconds = {}
+        return timings
+
+
+    def merge(self, timings):
+        """Adds calls and time returned by pop on another timer"""
+        for stage, (calls, secs) in timings.items():
+            self.add(stage, secs, calls)
+
+
+    def summary(self):
+        """Summarizes counters, rates, and time per stage as a string"""
+        elapsed = max(time.perf_counter() - self.started, 1e-9)
+        with self._lock:
+            counts = [f"{v:,} {k} ({v / elapsed:,.1f}/s)"
+                      for k, v in self.counts.items()]
+            stages = [f"{k}={self.seconds[k]:.2f}s/{self.calls[k]:,}"
+                      for k in sorted(self.seconds, key=self.seconds.get, reverse=True)]
+        return (f"{elapsed:.1f}s elapsed: {', '.join(counts) or 'nothing mined'}"
+                f" (times: {', '.join(stages)})")
+
+
+    def log(self):
+        """Logs a summary"""
+        logger.info(self.summary())
+
+
+    def report(self):
+        """Logs a summary and returns the stats as a dict"""
+        self.log()
+        with self._lock:
+            return {
+                "elapsed": time.perf_counter() - self.started,
+                "counts": dict(self.counts),
+                "calls": dict(self.calls),
+                "seconds": dict(self.seconds),
+            }
+
+
+
+
+class TimedProxy:
+    """Times calls to the methods of another object
+
+    Args:
+        obj (mixed): the object to wrap
+        timer (Timer): the timer that records the calls
+        stages (str or dict): the stage to record all method calls under or
+            a dict mapping method names to stages. If a dict, only the
+            listed methods are timed.
+    """
+
+    def __init__(self, obj, timer, stages):
+        self.__dict__["_obj"] = obj
+        self.__dict__["_timer"] = timer
+        self.__dict__["_stages"] = stages
+
+
+    def __getattr__(self, attr):
+        # Avoid proxying special attributes, which breaks pickling
+        if attr.startswith("__"):
+            raise AttributeError(attr)
+        val = getattr(self.__dict__["_obj"], attr)
+        stages = self.__dict__["_stages"]
+        if callable(val):
+            if isinstance(stages, str):
+                return self._timer.wrap(stages, val)
+            if attr in stages:
+                return self._timer.wrap(stages[attr], val)
+        return val
+
+
+    def __setattr__(self, attr, val):
+        setattr(self.__dict__["_obj"], attr, val)
@@ -1,12 +1,24 @@
 """Defines functions for reading/writing data to database"""
+import hashlib
+import importlib.metadata
+import inspect as inspect_module
 import logging
+import queue
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
 
+from sqlalchemy import func, inspect
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import FlushError
 from sqlalchemy.orm.util import identity_key
 
 from nmnh_ms_tools.bots import GeoGalleryBot
-from nmnh_ms_tools.records import Specimen
+from nmnh_ms_tools.records import CatNum, CatNums, Specimen
 from nmnh_ms_tools.tools.specimen_numbers.link import MatchMaker
 
 
@@ -17,15 +29,396 @@ logger = logging.getLogger(__name__)
 
 
 
+# Dialects that support INSERT ... ON CONFLICT
+INSERTS = {
+    "postgresql": postgresql.insert,
+    "sqlite": sqlite.insert,
+}
+
+
+
+
+class LRUCache:
+    """Bounded, thread-safe least-recently-used cache with hit counters"""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def __len__(self):
+        return len(self._data)
+
+
+    def __contains__(self, key):
+        return key in self._data
+
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0
+
+
+    def get(self, key, default=None, count=True):
+        """Returns the value for key, marking it as recently used
+
+        Args:
+            key (hashable): the key to look up
+            default (mixed): the value to return if key is missing
+            count (bool): whether to count the lookup as a hit or miss.
+                Callers that check other sources on a miss can pass False
+                and record the outcome with add_counts instead.
+
+        Returns:
+            Value for key or default if missing
+        """
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                if count:
+                    self.misses += 1
+                return default
+            if count:
+                self.hits += 1
+            return self._data[key]
+
+
+    def put(self, key, val):
+        """Adds or updates key, evicting the oldest key if full"""
+        with self._lock:
+            self._data[key] = val
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+    def get_or_call(self, key, func, *args, **kwargs):
+        """Returns the value for key, calling func to compute it if missing
+
+        Exceptions raised by func are cached and raised again on later
+        calls as new instances of the same type with the same args. Only
+        the type and args are kept, so cached errors do not hold on to
+        the frames of the call that raised them.
+        """
+        val = self.get(key, _MISSING)
+        if val is _MISSING:
+            try:
+                val = func(*args, **kwargs)
+            except Exception as exc_info:
+                self.put(key, _CachedError(exc_info))
+                raise
+            self.put(key, val)
+        if isinstance(val, _CachedError):
+            raise val.error()
+        return val
+
+
+    def info(self):
+        """Summarizes the size and hit rate of the cache"""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "size": len(self),
+            "maxsize": self.maxsize,
+        }
+
+
+    def add_counts(self, hits, misses):
+        """Adds hits and misses counted by a copy of the cache elsewhere"""
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+
+    def discard(self, key):
+        """Removes key if present"""
+        with self._lock:
+            self._data.pop(key, None)
+
+
+    def clear(self):
+        """Removes all keys and resets counters"""
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+
+
+class RateLimiter:
+    """Thread-safe token bucket that limits how often something happens
+
+    Args:
+        rate (float): average number of calls allowed per second
+        burst (int): number of calls that can be made at once after a
+            quiet period. Defaults to one second's worth.
+
+    Attributes:
+        waited (float): total seconds spent waiting for tokens
+    """
+
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError(f"rate must be positive: {rate}")
+        self.rate = rate
+        self.burst = max(1, burst if burst is not None else int(rate))
+        self.waited = 0
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+
+    def acquire(self):
+        """Waits until a call is allowed"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            # Reserve a token now and sleep outside the lock so that other
+            # threads can reserve the tokens after it
+            self._tokens -= 1
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0
+            self.waited += delay
+        if delay:
+            time.sleep(delay)
+
+
+
+
+class _CachedError:
+    """Stores the type and args of an exception raised by a cached call"""
+
+    def __init__(self, exc):
+        self.cls = exc.__class__
+        self.args = exc.args
+
+
+    def error(self):
+        """Creates a new exception matching the one that was cached"""
+        return self.cls(*self.args)
+
+
+
+
+_MISSING = object()
+# Worker processes get their own copy of the cache. Miner adds the hits
+# and misses from each worker to the counters here, but the size of the
+# cache only reflects this process.
+PARSE_CACHE = LRUCache(100000)
+
+
+
+
+def parser_key(parser):
+    """Returns a hashable key describing the configuration of a parser"""
+    attrs = []
+    for key, val in sorted(getattr(parser, "__dict__", {}).items()):
+        if isinstance(val, (bool, float, int, str, type(None))):
+            attrs.append((key, val))
+        elif isinstance(val, (list, tuple)):
+            attrs.append((key, repr(val)))
+    cls = parser.__class__
+    return (cls.__module__, cls.__qualname__, tuple(attrs))
+
+
+def parser_version(parser):
+    """Fingerprints a parser using its package version, source, and settings
+
+    The fingerprint changes when the package is upgraded, when the module
+    defining the parser is edited (for example, in an editable install),
+    or when the parser is configured differently.
+    """
+    module = sys.modules.get(parser.__class__.__module__)
+    package = parser.__class__.__module__.split(".")[0]
+    try:
+        version = importlib.metadata.version(package)
+    except importlib.metadata.PackageNotFoundError:
+        version = getattr(sys.modules.get(package), "__version__", "")
+    try:
+        with open(inspect_module.getsourcefile(module), "rb") as f:
+            source = hashlib.md5(f.read()).hexdigest()
+    except (OSError, TypeError):
+        source = ""
+    key = repr((version, source, parser_key(parser)))
+    return hashlib.md5(key.encode("utf-8")).hexdigest()
+
+
+def parse_spec_nums(parser, verbatim, key=None):
+    """Parses catalog numbers from a verbatim string using the parse cache
+
+    Args:
+        parser (Parser): the parser used to parse the string
+        verbatim (str): the string to parse
+        key (tuple): the parser_key for the parser. Calculated if not given.
+
+    Returns:
+        List of catalog numbers
+    """
+    if key is None:
+        key = parser_key(parser)
+    return list(PARSE_CACHE.get_or_call((key, verbatim), parser.parse, verbatim))
+
+
+def parse_catnum(val):
+    """Creates a CatNum using the parse cache
+
+    Only strings are cached. The returned object is shared with the cache
+    and other callers, so it must not be modified. Copy it first if needed.
+    """
+    if not isinstance(val, str):
+        return CatNum(val)
+    return PARSE_CACHE.get_or_call(("CatNum", val), CatNum, val)
+
+
+def parse_catnums(vals):
+    """Creates a CatNums object from a list using the parse cache
+
+    Only lists of strings are cached, so pass the verbatim strings rather
+    than CatNum objects. The returned object is shared with the cache and
+    other callers, so neither it nor the catalog numbers in it may be
+    modified. Copy it first if needed.
+    """
+    if not all(isinstance(v, str) for v in vals):
+        return CatNums(vals)
+    key = ("CatNums", tuple(vals))
+    return PARSE_CACHE.get_or_call(key, CatNums, list(vals))
+
+
+
+
+@dataclass
+class CommitStats:
+    """Counts and timings for records committed to one table
+
+    Attributes:
+        submitted (int): records passed to the wrapper
+        duplicates (int): records removed as duplicates within a batch
+        cached (int): records removed because they were already committed
+        written (int): rows inserted or updated
+        rejected (int): records that could not be committed
+        deleted (int): rows deleted
+        levels (dict): number of batches resolved at each fallback level
+            (bulk, orm, merge, or bisect)
+        seconds (dict): wall time spent in each stage
+    """
+    submitted: int = 0
+    duplicates: int = 0
+    cached: int = 0
+    written: int = 0
+    rejected: int = 0
+    deleted: int = 0
+    levels: dict = field(default_factory=dict)
+    seconds: dict = field(default_factory=dict)
+
+
+    def add_time(self, stage, secs):
+        """Adds time spent in a stage"""
+        self.seconds[stage] = self.seconds.get(stage, 0) + secs
+
+
+    def update(self, other):
+        """Adds counts and timings from another CommitStats object"""
+        for attr in ("submitted", "duplicates", "cached", "written", "rejected",
+                     "deleted"):
+            setattr(self, attr, getattr(self, attr) + getattr(other, attr))
+        for key, val in other.levels.items():
+            self.levels[key] = self.levels.get(key, 0) + val
+        for key, val in other.seconds.items():
+            self.add_time(key, val)
+
+
+    def to_dict(self):
+        """Converts stats to a dict"""
+        return asdict(self)
+
+
+
+
 class SessionWrapper:
-    """Wraps sqlalchemy session to prevent IntegrityErrors"""
+    """Wraps sqlalchemy session to prevent IntegrityErrors
+
+    Args:
+        sessionmaker (sqlalchemy.orm.sessionmaker): creates new sessions
+        limit (int): number of records to hold before committing
+        bulk (bool): whether to write records using INSERT ... ON CONFLICT
+            statements instead of the ORM. Falls back to the ORM if the
+            dialect does not support upserts or the bulk insert fails.
+        on_conflict (str or dict): how bulk inserts handle existing rows.
+            One of "ignore" (keep existing row) or "update" (overwrite
+            existing row with any non-null values from the new record), or
+            a dict mapping models to one of those values. Models missing
+            from the dict use "ignore". Columns listed in a model's
+            _upsert_replace attribute are overwritten even when null.
+        cache_size (int): number of committed records to remember per
+            table. Records identical to one already committed by this
+            wrapper are dropped before they reach the session.
+        background (bool): whether to commit records on a dedicated writer
+            thread. The writer uses its own session, so the session
+            exposed by this wrapper is only used for reads.
+        queue_size (int): number of batches that can wait for the writer
+            thread before add_all and commit block
+        target_latency (float): if given, the limit is adjusted after each
+            commit so that commits take about this many seconds
+        max_bytes (int): if given, commits once the string and binary
+            values of the pending records exceed this many bytes
+        min_limit (int): smallest limit allowed when adapting the limit
+        max_limit (int): largest limit allowed when adapting the limit
+        log_interval (float): if given, logs cumulative stats at most
+            once per this many seconds
+
+    Attributes:
+        rejected (list): (record, exception) tuples for records that could
+            not be committed
+        stats (dict): cumulative CommitStats keyed by class name
+        last_stats (dict): CommitStats for the last batch keyed by class name
+    """
 
-    def __init__(self, sessionmaker, limit=1):
+    def __init__(self, sessionmaker, limit=1, bulk=False, on_conflict="ignore",
+                 cache_size=0, background=False, queue_size=2,
+                 target_latency=None, max_bytes=None, min_limit=100,
+                 max_limit=100000, log_interval=None):
+        policies = on_conflict
+        if not isinstance(on_conflict, dict):
+            policies = {None: on_conflict}
+        for policy in policies.values():
+            if policy not in {"ignore", "update"}:
+                raise ValueError(f"Invalid on_conflict: {policy}")
         self._sessionmaker = sessionmaker
         self._session = None
         self._records = []
+        self._deletes = {}
         self.limit = limit
+        self.bulk = bulk
+        self.on_conflict = on_conflict
         self.order = []
+        self.rejected = []
+        self.cache_size = cache_size
+        self._cache = {}
+        self.background = background
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._writer = None
+        self._error = None
+        self.target_latency = target_latency
+        self.max_bytes = max_bytes
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self._bytes = 0
+        self._depth = 0
+        self._secs_per_record = None
+        self.stats = {}
+        self.last_stats = {}
+        self.log_interval = log_interval
+        self._last_logged = time.perf_counter()
+        self._stats_lock = threading.Lock()
 
 
     def __len__(self):
@@ -55,43 +448,395 @@ class SessionWrapper:
 
     def add_all(self, recs):
         """Adds records to current session, committing if more than limit"""
+        self._raise_writer_error()
         self._records.extend(recs)
-        if len(self) >= self.limit:
+        if self.max_bytes:
+            self._bytes += sum(self._sizeof(r) for r in recs)
+        if not self._depth and self._is_full():
+            self.commit()
+
+
+    def delete_all(self, model, keys):
+        """Deletes rows by primary key as part of the next commit
+
+        Deletes run before the records in the same batch are written. If
+        order is set, tables are deleted from in reverse order so that
+        child rows are removed before their parents.
+
+        Args:
+            model (Base): the model for the table to delete from. The table
+                must have a single-column primary key.
+            keys (iterable): primary keys of the rows to delete
+        """
+        keys = set(keys)
+        if not keys:
+            return
+        self._raise_writer_error()
+        if len(model.__table__.primary_key.columns) != 1:
+            raise ValueError(f"{model.__name__} has a composite primary key")
+        self._deletes.setdefault(model, set()).update(keys)
+        # Forget deleted rows so identical records can be written again
+        cache = self._cache.get(model.__name__)
+        if cache is not None:
+            for key in keys:
+                cache.discard((key,))
+
+
+    @contextmanager
+    def group(self):
+        """Defers automatic commits until the block exits
+
+        Use to keep related records (for example, everything mined from
+        one publication) in the same commit. Commits on exit if the limit
+        has been reached.
+        """
+        self._depth += 1
+        try:
+            yield self
+        finally:
+            self._depth -= 1
+        if not self._depth and self._is_full():
             self.commit()
 
 
     def commit(self):
-        """Safely commits records from the current session"""
-        if self._records:
+        """Safely commits records from the current session
+
+        In background mode, the records are handed to the writer thread
+        and this method returns once they have been queued. Use flush to
+        wait until they have been written.
+        """
+        self._raise_writer_error()
+        if self._records or self._deletes:
             logger.info(f"Committing {len(self):,} records")
-            records = []
+            groups = []
+            stats = {}
+            fingerprints = {}
             for group in self._order_records():
-                records.extend(self._remove_duplicates(group))
-            try:
-                self.session.add_all(records)
-                self.session.commit()
-            except (FlushError, IntegrityError):
-                self.session.rollback()
-                try:
-                    for rec in records:
-                        self.session.merge(rec)
-                    self.session.commit()
-                except (FlushError, IntegrityError):
-                    self.session.rollback()
-                    for rec in records:
-                        try:
-                            self.session.merge(rec)
-                            self.session.commit()
-                        except (FlushError, IntegrityError) as exc_info:
-                            self.session.rollback()
-                            logger.error(f"Failed to commit {group}: {exc_info}")
+                start = time.perf_counter()
+                name = group[0].__class__.__name__
+                stats[name] = CommitStats(submitted=len(group))
+                records = self._remove_duplicates(group)
+                stats[name].duplicates = len(group) - len(records)
+                if self.cache_size:
+                    uncached = self._remove_cached(records, fingerprints)
+                    stats[name].cached = len(records) - len(uncached)
+                    records = uncached
+                if records:
+                    groups.append(records)
+                stats[name].add_time("prepare", time.perf_counter() - start)
+            deletes = self._order_deletes()
+            if self.background:
+                self._start_writer()
+                self._queue.put((groups, stats, deletes, fingerprints))
+            else:
+                self._write(groups, stats, self.session, deletes, fingerprints)
             self._records = []
+            self._deletes = {}
+            self._bytes = 0
+
+
+    def flush(self):
+        """Commits pending records and waits until they are written"""
+        self.commit()
+        if self._writer is not None:
+            self._queue.join()
+        self._raise_writer_error()
 
 
     def close(self):
-        """Closes the current session"""
-        self.session.close()
-        self.session = None
+        """Writes pending records and closes the current session"""
+        try:
+            self.flush()
+        finally:
+            if self._writer is not None:
+                self._queue.put(None)
+                self._writer.join()
+                self._writer = None
+            self.session.close()
+            self.session = None
+
+
+    def _start_writer(self):
+        """Starts the writer thread if it is not already running"""
+        if self._writer is None:
+            self._writer = threading.Thread(
+                target=self._run_writer, name="SessionWrapperWriter", daemon=True
+            )
+            self._writer.start()
+
+
+    def _run_writer(self):
+        """Commits batches from the queue until it receives None"""
+        session = self._sessionmaker()
+        try:
+            while True:
+                batch = self._queue.get()
+                try:
+                    if batch is None:
+                        break
+                    groups, stats, deletes, fingerprints = batch
+                    self._write(groups, stats, session, deletes, fingerprints)
+                except Exception as exc_info:
+                    logger.error(f"Writer thread failed: {exc_info}")
+                    session.rollback()
+                    if self._error is None:
+                        self._error = exc_info
+                finally:
+                    self._queue.task_done()
+        finally:
+            session.close()
+
+
+    def _raise_writer_error(self):
+        """Raises the first error encountered by the writer thread"""
+        if self._error is not None:
+            exc, self._error = self._error, None
+            raise exc
+
+
+    def _write(self, groups, stats, session, deletes=None, fingerprints=None):
+        """Writes ordered groups of records using the given session
+
+        Deletes are committed in the same transaction as the records when
+        the bulk upsert succeeds and in their own transaction otherwise.
+        Fingerprints maps id(rec) to the (key, fingerprint) tuples used to
+        update the cache once the records have been written.
+        """
+        num_rejected = len(self.rejected)
+        start = time.perf_counter()
+        if not (self.bulk and self._commit_bulk(groups, stats, session, deletes)):
+            if deletes:
+                self._delete(deletes, stats, session)
+                session.commit()
+            self._commit_orm([r for g in groups for r in g], stats, session)
+        elapsed = time.perf_counter() - start
+        if self.target_latency:
+            num_records = sum(len(g) for g in groups)
+            self._adapt_limit(num_records, elapsed)
+
+        # Tally rejected records and update the cache with the rest
+        rejected = {id(r) for r, _ in self.rejected[num_rejected:]}
+        for group in groups:
+            group_stats = stats[group[0].__class__.__name__]
+            committed = [r for r in group if id(r) not in rejected]
+            group_stats.rejected = len(group) - len(committed)
+            if "bulk" not in group_stats.levels:
+                group_stats.written = len(committed)
+            if self.cache_size and fingerprints is not None:
+                self._cache_records(committed, fingerprints)
+        self._update_stats(stats)
+
+
+    def _update_stats(self, stats):
+        """Adds stats from a batch to the cumulative stats"""
+        with self._stats_lock:
+            self.last_stats = stats
+            for name, group_stats in stats.items():
+                self.stats.setdefault(name, CommitStats()).update(group_stats)
+            now = time.perf_counter()
+            if self.log_interval and now - self._last_logged >= self.log_interval:
+                self._last_logged = now
+                self.log_stats()
+
+
+    def log_stats(self):
+        """Logs cumulative stats for each table"""
+        for name, stats in self.stats.items():
+            levels = ", ".join(f"{k}={v:,}" for k, v in stats.levels.items())
+            seconds = ", ".join(f"{k}={v:.2f}s" for k, v in stats.seconds.items())
+            logger.info(
+                f"{name}: {stats.submitted:,} submitted,"
+                f" {stats.duplicates:,} duplicates, {stats.cached:,} cached,"
+                f" {stats.written:,} written, {stats.rejected:,} rejected,"
+                f" {stats.deleted:,} deleted"
+                f" (levels: {levels}; times: {seconds})"
+            )
+
+
+    def _is_full(self):
+        """Tests whether pending records have reached the limit"""
+        if len(self) >= self.limit:
+            return True
+        return bool(self.max_bytes and self._bytes >= self.max_bytes)
+
+
+    def _adapt_limit(self, num_records, elapsed):
+        """Resizes the limit based on the time taken by the last commit"""
+        if not num_records:
+            return
+        secs_per_record = elapsed / num_records
+        if self._secs_per_record is not None:
+            # Smooth measurements to avoid chasing noisy commits
+            secs_per_record = 0.5 * (self._secs_per_record + secs_per_record)
+        self._secs_per_record = secs_per_record
+        limit = self.target_latency / max(secs_per_record, 1e-9)
+        # Limit growth to a factor of two per commit
+        limit = min(limit, 2 * self.limit, self.max_limit)
+        self.limit = max(int(limit), self.min_limit)
+        logger.debug(f"Commit limit set to {self.limit:,} records")
+
+
+    def _commit_bulk(self, groups, stats, session, deletes=None):
+        """Commits deletes and records using one executemany upsert per table
+
+        Returns:
+            True if the records were committed, False otherwise
+        """
+        dialect = session.bind.dialect.name
+        try:
+            insert = INSERTS[dialect]
+        except KeyError:
+            logger.warning(f"Bulk upserts not supported by {dialect}")
+            return False
+        try:
+            if deletes:
+                self._delete(deletes, stats, session)
+            written = {}
+            for group in groups:
+                start = time.perf_counter()
+                table = group[0].__table__
+                stmt = insert(table)
+                if self._conflict_policy(group[0].__class__) == "update":
+                    keys = [c.name for c in table.primary_key.columns]
+                    # Keep existing values for columns the new row leaves
+                    # empty unless the model says to replace them
+                    replace = set(getattr(group[0], "_upsert_replace", ()))
+                    update = {
+                        c.name: stmt.excluded[c.name] if c.name in replace
+                                else func.coalesce(stmt.excluded[c.name], c)
+                        for c in table.columns if not c.primary_key
+                    }
+                    if update:
+                        stmt = stmt.on_conflict_do_update(
+                            index_elements=keys, set_=update
+                        )
+                    else:
+                        stmt = stmt.on_conflict_do_nothing()
+                else:
+                    stmt = stmt.on_conflict_do_nothing()
+                result = session.execute(stmt, [self._to_dict(r) for r in group])
+                name = group[0].__class__.__name__
+                written[name] = result.rowcount
+                stats[name].add_time("bulk", time.perf_counter() - start)
+            start = time.perf_counter()
+            session.commit()
+            self._add_level(stats, "bulk", time.perf_counter() - start)
+        except IntegrityError as exc_info:
+            # Conflicts on constraints other than the primary key raise an
+            # error when updating, so retry those batches using the ORM
+            session.rollback()
+            logger.warning(f"Bulk commit failed: {exc_info}")
+            return False
+        for name, count in written.items():
+            stats[name].written = count
+        return True
+
+
+    def _conflict_policy(self, model):
+        """Returns how bulk inserts handle existing rows for a model"""
+        if isinstance(self.on_conflict, dict):
+            return self.on_conflict.get(model, "ignore")
+        return self.on_conflict
+
+
+    def _commit_orm(self, records, stats, session):
+        """Commits records using the ORM, merging records on failure"""
+        start = time.perf_counter()
+        try:
+            session.add_all(records)
+            session.commit()
+        except (FlushError, IntegrityError):
+            session.rollback()
+            self._add_level(stats, None, time.perf_counter() - start, "orm")
+            start = time.perf_counter()
+            try:
+                for rec in records:
+                    session.merge(self._for_merge(rec))
+                session.commit()
+            except (FlushError, IntegrityError) as exc_info:
+                session.rollback()
+                self._add_level(stats, None, time.perf_counter() - start, "merge")
+                start = time.perf_counter()
+                self._commit_bisect(records, session, failed=exc_info)
+                self._add_level(stats, "bisect", time.perf_counter() - start)
+            else:
+                self._add_level(stats, "merge", time.perf_counter() - start)
+        else:
+            self._add_level(stats, "orm", time.perf_counter() - start)
+
+
+    def _delete(self, deletes, stats, session, chunk_size=500):
+        """Deletes rows by primary key without committing"""
+        for model, keys in deletes:
+            start = time.perf_counter()
+            name = model.__name__
+            col = list(model.__table__.primary_key.columns)[0]
+            deleted = 0
+            for i in range(0, len(keys), chunk_size):
+                stmt = model.__table__.delete().where(col.in_(keys[i:i + chunk_size]))
+                deleted += session.execute(stmt).rowcount
+            stats.setdefault(name, CommitStats()).deleted += deleted
+            stats[name].add_time("delete", time.perf_counter() - start)
+
+
+    @staticmethod
+    def _add_level(stats, level, secs, stage=None):
+        """Records the fallback level and time taken for each table
+
+        Stages that cover the whole batch add their time to every table.
+        """
+        if stage is None:
+            stage = level
+        for group_stats in stats.values():
+            if level:
+                group_stats.levels[level] = group_stats.levels.get(level, 0) + 1
+            group_stats.add_time(stage, secs)
+
+
+    def _commit_bisect(self, records, session, failed=None):
+        """Commits records by recursively splitting a failing batch
+
+        Isolating k bad records from a batch of n takes O(k log n) commits.
+        Records that fail on their own are added to the rejected list as
+        (record, exception) tuples.
+
+        Args:
+            records (list): records to commit
+            session (sqlalchemy.orm.Session): the session to commit with
+            failed (Exception): the error raised when the caller already
+                tried to merge the whole batch. If given, the batch is split
+                without trying it again.
+        """
+        if failed is None:
+            try:
+                for rec in records:
+                    session.merge(self._for_merge(rec))
+                session.commit()
+                return
+            except (FlushError, IntegrityError) as exc_info:
+                session.rollback()
+                failed = exc_info
+        if len(records) == 1:
+            logger.error(f"Failed to commit {records[0]}: {failed}")
+            self.rejected.append((records[0], failed))
+        else:
+            mid = len(records) // 2
+            self._commit_bisect(records[:mid], session)
+            self._commit_bisect(records[mid:], session)
+
+
+    @staticmethod
+    def _for_merge(rec):
+        """Sets replaceable columns missing from a record so merge clears them
+
+        Merge only copies attributes that have been set, so columns listed
+        in _upsert_replace are set to None if the record leaves them out.
+        """
+        for name in getattr(rec, "_upsert_replace", ()):
+            if name not in rec.__dict__:
+                setattr(rec, name, None)
+        return rec
 
 
     @staticmethod
@@ -101,6 +846,71 @@ class SessionWrapper:
         return list(group.values())
 
 
+    def _get_cache(self, rec):
+        """Returns the key cache for the table of the given record"""
+        name = rec.__class__.__name__
+        if name not in self._cache:
+            self._cache[name] = LRUCache(self.cache_size)
+        return self._cache[name]
+
+
+    def _remove_cached(self, records, fingerprints):
+        """Removes records identical to ones already committed
+
+        Adds the key and fingerprint of each record that is kept to
+        fingerprints so the cache can be updated without reading the
+        records again after the write. Records committed through the ORM
+        are expired, and reading them would reload each one.
+        """
+        if not records:
+            return records
+        cache = self._get_cache(records[0])
+        uncached = []
+        for rec in records:
+            key = identity_key(instance=rec)[1]
+            fingerprint = self._fingerprint(rec)
+            if cache.get(key) != fingerprint:
+                uncached.append(rec)
+                fingerprints[id(rec)] = (key, fingerprint)
+        return uncached
+
+
+    def _cache_records(self, records, fingerprints):
+        """Adds committed records to the key cache"""
+        if records:
+            cache = self._get_cache(records[0])
+            for rec in records:
+                cache.put(*fingerprints[id(rec)])
+
+
+    def _fingerprint(self, rec):
+        """Hashes the column values of a record"""
+        return hash(tuple(self._to_dict(rec).values()))
+
+
+    @staticmethod
+    def _sizeof(rec):
+        """Approximates the payload of a record in bytes"""
+        return sum(len(v) for v in rec.__dict__.values()
+                   if isinstance(v, (str, bytes)))
+
+
+    @staticmethod
+    def _to_dict(rec):
+        """Maps the columns of a record to their values"""
+        mapper = inspect(rec).mapper
+        return {a.columns[0].key: getattr(rec, a.key) for a in mapper.column_attrs}
+
+
+    def _order_deletes(self):
+        """Orders pending deletes so child tables are deleted from first"""
+        deletes = list(self._deletes.items())
+        if self.order:
+            rank = {c.__name__: i for i, c in enumerate(self.order)}
+            deletes.sort(key=lambda d: rank.get(d[0].__name__, -1), reverse=True)
+        return [(model, sorted(keys)) for model, keys in deletes]
+
+
     def _order_records(self):
         """Orders a list of records prior to commit"""
         if self.order:
@@ -108,4 +918,8 @@ class SessionWrapper:
             for rec in self._records:
                 ordered[rec.__class__.__name__].append(rec)
             return list([o for o in ordered.values() if o])
-        return [self._records] if self._records else []
+        # Group by class in the order each class first appears
+        ordered = {}
+        for rec in self._records:
+            ordered.setdefault(rec.__class__.__name__, []).append(rec)
+        return list(ordered.values())
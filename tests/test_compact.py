@@ -0,0 +1,122 @@
+"""Tests reading and writing compact citation databases"""
+import csv
+import hashlib
+import os
+import sqlite3
+
+import pytest
+
+from speciminer.databases.citations import (
+    DarwinCore,
+    Document,
+    Link,
+    Session,
+    Snippet,
+    Specimen,
+    compact_db,
+    init_db,
+    open_compact_db,
+)
+from speciminer.matchers.match_database import DatabaseMatcher
+
+
+
+
+def _md5(val):
+    return hashlib.md5(val.encode("utf-8")).hexdigest()
+
+
+def _read_csv(path):
+    """Reads an export, sorting snippets because compact_db reorders rows"""
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        rows = list(csv.DictReader(f))
+    for row in rows:
+        row["snippets"] = sorted(row["snippets"].split("\n"))
+    return sorted(rows, key=lambda row: (row["doc_url"], row["spec_num"]))
+
+
+def _export(tmp_path, name):
+    path = str(tmp_path / name)
+    DatabaseMatcher().to_csv(path)
+    return _read_csv(path)
+
+
+@pytest.fixture
+def src(tmp_path):
+    """Creates a small citations database"""
+    path = str(tmp_path / "citations.sqlite")
+    init_db(path)
+    session = Session()
+    for i in range(3):
+        doc_url = f"https://example.org/doc/{i}"
+        session.add(Document(url=doc_url, title=f"Document {i}", kind="article"))
+        for j in range(2):
+            spec_num = f"USNM {1000 + j}"
+            snippet = f"Document {i} page {j} mentions {spec_num}"
+            snippet_id = _md5(snippet)
+            session.add(Snippet(id=snippet_id,
+                                doc_url=doc_url,
+                                page_id=str(j),
+                                snippet=snippet))
+            session.add(Specimen(id=_md5(snippet_id + spec_num),
+                                 snippet_id=snippet_id,
+                                 verbatim=spec_num,
+                                 spec_num=spec_num))
+            ezid = f"ark:/65665/{_md5(spec_num)}"
+            session.add(Link(id=_md5(doc_url + spec_num),
+                             doc_url=doc_url,
+                             verbatim=spec_num,
+                             spec_num=spec_num,
+                             ezid=ezid,
+                             department="Mineral Sciences",
+                             match_quality="Matched catalog number"))
+            session.merge(DarwinCore(id=ezid, scientific_name="Quartz"))
+    session.commit()
+    session.close()
+    Session.kw["bind"].dispose()
+    return path
+
+
+
+
+def test_compact_db_matches_source(src, tmp_path):
+    expected = _export(tmp_path, "src.csv")
+    assert len(expected) == 6
+
+    dst = str(tmp_path / "compact.sqlite")
+    compact_db(src, dst)
+    Session.configure(bind=open_compact_db(dst))
+    assert _export(tmp_path, "compact.csv") == expected
+
+
+def test_compact_db_does_not_modify_source(src, tmp_path):
+    os.chmod(src, 0o444)
+    mtime = os.path.getmtime(src)
+    compact_db(src, str(tmp_path / "compact.sqlite"))
+    assert os.path.getmtime(src) == mtime
+
+
+def test_compact_db_requires_current_schema(src, tmp_path):
+    with sqlite3.connect(src) as conn:
+        conn.execute("DELETE FROM schema_version"
+                     " WHERE version = (SELECT MAX(version) FROM schema_version)")
+    dst = str(tmp_path / "compact.sqlite")
+    with pytest.raises(ValueError):
+        compact_db(src, dst)
+    assert not os.path.exists(dst)
+
+
+def test_compact_db_maintains_counts(src, tmp_path):
+    dst = str(tmp_path / "compact.sqlite")
+    compact_db(src, dst)
+    with sqlite3.connect(dst) as conn:
+        doc_id, num_snippets = conn.execute(
+            "SELECT id, num_snippets FROM documents ORDER BY id"
+        ).fetchone()
+        conn.execute(
+            "INSERT INTO snippets (hash, doc_id, snippet) VALUES (?, ?, ?)",
+            (b"\x00" * 16, doc_id, "USNM 1")
+        )
+        assert conn.execute(
+            "SELECT num_snippets FROM documents WHERE id = ?", (doc_id,)
+        ).fetchone()[0] == num_snippets + 1